@@ -1,13 +1,65 @@
 # encoding: utf-8
+import time
+import logging
 import urllib3
 import settings
-from requests import request, Session
+import multiprocessing
+from lib.metrics import metrics
+from requests import Session
 from json import dumps
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+logger = logging.getLogger("app")
+
+
+class TokenManager(object):
+    """ Beedata authentication token shared by every process created after it: only one process logs in and the
+    others reuse its token. Token is renewed before it expires (ttl minus margin seconds) or when it is rejected.
+    Shared objects are created with the multiprocessing context (start method) used by the workers """
+    def __init__(self, ttl=None, margin=None, size=4096, context=None):
+        context = context or multiprocessing
+        self.ttl = ttl or settings.BEEDATA_TOKEN_TTL
+        self.margin = margin if margin is not None else settings.BEEDATA_TOKEN_REFRESH_MARGIN
+        self._lock = context.Lock()
+        self._token = context.Array('c', size, lock=False)
+        self._expires = context.Value('d', 0.0, lock=False)
+
+    def get(self, login):
+        """ Returns current token, calling login to get a new one if there is none or it is about to expire
+
+        :param login: function performing the login request and returning the token
+        """
+        with self._lock:
+            if not self._token.value or time.time() >= self._expires.value:
+                token = login()
+                self._token.value = token.encode('utf-8')
+                self._expires.value = time.time() + self.ttl - self.margin
+                logger.debug('New Beedata token valid for [%s] seconds', self.ttl - self.margin)
+
+            return self._token.value.decode('utf-8')
+
+    def invalidate(self, token):
+        """ Marks token as expired if it is still the current one, so it is only renewed once when several
+        processes get it rejected """
+        with self._lock:
+            if self._token.value.decode('utf-8') == token:
+                self._expires.value = 0.0
+
+
+# token manager shared by every BaseClient. It has to be set before forking workers
+_token_manager = None
+
+
+def set_token_manager(token_manager):
+    global _token_manager
+    _token_manager = token_manager
+
+
+def get_token_manager():
+    return _token_manager
 
 
 class BaseClient(object):
@@ -23,28 +75,78 @@ class BaseClient(object):
         self.base_url = settings.BEEDATA_BASE_URL
         self.username = settings.BEEDATA_LOGIN_USER
         self.password = settings.BEEDATA_LOGIN_PASSWORD
+        self.token_manager = get_token_manager() or TokenManager()
+        self.session = self.create_session()
 
-    def do_login(self):
-        """ Perform login request to set authentication cookie""" 
+    def create_session(self):
+        """ Creates a keep-alive connection pooled session shared by every request of this client.
+        Retries and backoff are applied to all HTTP verbs
+        """
+        session = Session()
+        retries = Retry(total=settings.BEEDATA_RETRIES,
+                        backoff_factor=settings.BEEDATA_BACKOFF_FACTOR,
+                        status_forcelist=settings.BEEDATA_RETRY_STATUS,
+                        raise_on_status=False,
+                        method_whitelist=frozenset(['GET', 'POST', 'PATCH', 'PUT', 'DELETE', 'HEAD', 'OPTIONS']))
+        adapter = HTTPAdapter(pool_connections=settings.BEEDATA_POOL_CONNECTIONS,
+                              pool_maxsize=settings.BEEDATA_POOL_SIZE,
+                              max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(self.http_headers)
+        session.headers['Connection'] = 'keep-alive'
+        session.cert = self.certificate
+        session.verify = False
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        """ Performs a request through the client session with authentication cookie.
+        If token is rejected (401) a new one is recovered and the request is sent again
+        
+        :param method: HTTP verb
+        :param url: full url for the request
+        """
+        with metrics.timer('beedata_request_seconds', method=method) as labels:
+            token = self.token_manager.get(self.login)
+            response = self.session.request(method, url, cookies={'iPlanetDirectoryPro': token}, **kwargs)
+            if response.status_code == 401:
+                logger.info('Beedata token rejected. Logging in again...')
+                metrics.inc('beedata_token_rejected_total')
+                self.token_manager.invalidate(token)
+                token = self.token_manager.get(self.login)
+                response = self.session.request(method, url, cookies={'iPlanetDirectoryPro': token}, **kwargs)
+            labels['status'] = response.status_code
+        
+        return response
+
+    def login(self):
+        """ Perform login request and return authentication token """
         data = {'username': self.username, 'password': self.password}
         # login request
-        response = request('POST', self.base_url + '/authn/login',
-                           data=dumps(data), headers=self.http_headers, verify=False)
+        response = self.session.post(self.base_url + '/authn/login', data=dumps(data))
+
+        return response.json()['token']
+
+    def do_login(self):
+        """ Perform login request to set authentication cookie""" 
         # setting cookie for response
-        self.cookie = {'iPlanetDirectoryPro': response.json()['token']}
+        self.cookie = {'iPlanetDirectoryPro': self.login()}
 
         return self.cookie
 
     def do_logout(self):
         """ Perform logout request"""
         # logout request
-        request('GET', self.base_url + '/authn/logout', headers=self.http_headers, verify=False)
+        self.session.get(self.base_url + '/authn/logout')
+
+    def close(self):
+        """ Close every pooled connection """
+        self.session.close()
 
     def get_contract(self, contract_id):
         
-        response = request('GET', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % contract_id,
-                           cookies=self.cookie or self.do_login(), headers=self.http_headers,
-                           cert=self.certificate, verify=False)
+        response = self.request('GET', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % contract_id)
         
         contract = None
         if response.status_code == 200:
@@ -59,23 +161,89 @@ class BaseClient(object):
         :param data: document to POST
         :param type: one of contracts or measures
         """
-        s = Session()
+        response = self.request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS[type],
+                                data=dumps(data))
+        
+        return response
+        
+
+    def send_body(self, body, type):
+        """ Function to POST an already serialized JSON body
+        
+        :param body: JSON body as bytes
+        :param type: one of contracts or measures
+        """
+        response = self.request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS[type],
+                                data=body)
+        
+        return response
 
-        retries = Retry(total=5,
-                backoff_factor=0.5,
-                status_forcelist=[ 500, 502, 503, 504 ])
+    def get_contracts_etags(self, contract_ids):
+        """ Recovers _etag of several contracts with paginated GET requests filtered by contractId
         
-        s.mount('https://', HTTPAdapter(max_retries=retries))
+        :param contract_ids: list of contractId to look for
         
-        #response = request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS[type],
-        response = s.post(settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS[type],
-                           cookies=self.cookie or self.do_login(), headers=self.http_headers,
-                           cert=self.certificate, verify=False,
-                           data=dumps(data))
+        :return dict with _etag for every contractId found on BeeData API or None if response was unexpected
+        """
+        etags = {}
+        page = 1
+        while True:
+            response = self.request('GET', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'],
+                                    params={
+                                        'where': dumps({'contractId': {'$in': contract_ids}}),
+                                        'projection': dumps({'contractId': 1}),
+                                        'max_results': len(contract_ids),
+                                        'page': page
+                                    })
+            if response.status_code != 200:
+                return None
+            
+            body = response.json()
+            for item in body.get('_items', []):
+                etags[item['contractId']] = item['_etag']
+            if not body.get('_items') or 'next' not in body.get('_links', {}):
+                break
+            page += 1
             
+        return etags
+
+    def send_bulk(self, documents, type):
+        """ Function to POST several documents with a single request
         
-        return response
+        :param documents: list of documents to POST
+        :param type: one of contracts or measures
+        
+        :return list of (status_code, error, _etag) tuples, one for every document in the same order
+        """
+        response = self.request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS[type],
+                                data=dumps(documents))
+        try:
+            items = response.json().get('_items')
+        except ValueError:
+            items = None
+        if not isinstance(items, list) or len(items) != len(documents):
+            items = None
+        
+        if response.status_code == 201:
+            return [(response.status_code, None, item.get('_etag')) for item in (items or [{}] * len(documents))]
+        
+        if not items:
+            return [(response.status_code, response.text, None)] * len(documents)
+        
+        # bulk POST is rejected as a whole, send again documents that were not rejected by themselves
+        valid = [document for document, item in zip(documents, items) if item.get('_status') != 'ERR']
+        if len(valid) == len(documents):
+            return [(response.status_code, response.text, None)] * len(documents)
+        retried = iter(self.send_bulk(valid, type) if valid else [])
+        
+        results = []
+        for item in items:
+            if item.get('_status') == 'ERR':
+                results.append((response.status_code, dumps(item.get('_issues', item)), None))
+            else:
+                results.append(next(retried))
         
+        return results
 
     def modify_contract(self, data, _etag=None):
         """ Function to PATCH contract getting its etag from BeeData API.
@@ -84,30 +252,19 @@ class BaseClient(object):
         """
         # GET request to recover _etag field from BeeData API
         if not _etag:
-            response = request('GET', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % data['contractId'],
-                               cookies=self.cookie or self.do_login(), headers=self.http_headers,
-                               cert=self.certificate, verify=False)
+            response = self.request('GET', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % data['contractId'])
             response = response.json()
         else:
             response = {'_etag': _etag }
 
         # If the contract already exists in BeeData a PATCH is needed else we need to create the new contract in BeeData
         if '_etag' in response:
-            # add If-Match header
-            headers = {
-                'Content-type': 'application/json',
-                'X-CompanyId': str(settings.BEEDATA_COMPANYID),
-                'If-Match': response['_etag']
-            }
-            # PATCH request
-            response = request('PATCH', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % data['contractId'],
-                               cookies=self.cookie or self.do_login(), headers=headers,
-                               cert=self.certificate, verify=False,
-                               data=dumps(data))
+            # PATCH request with If-Match header
+            response = self.request('PATCH', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'] + '/%s' % data['contractId'],
+                                    headers={'If-Match': response['_etag']},
+                                    data=dumps(data))
         else:
-            response = request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'],
-                               cookies=self.cookie or self.do_login(), headers=self.http_headers,
-                               cert=self.certificate, verify=False,
-                               data=dumps(data))
+            response = self.request('POST', settings.BEEDATA_BASE_URL + settings.BEEDATA_ENDPOINTS['contracts'],
+                                    data=dumps(data))
             
         return response
@@ -0,0 +1,168 @@
+# encoding: utf-8
+
+# utils imports
+import os
+import gzip
+import time
+import hashlib
+import logging
+import threading
+from json import dumps, loads
+from datetime import datetime
+
+# custom imports
+import settings
+
+logger = logging.getLogger("app")
+
+
+def serialize_response(data):
+    """ Keeps from consulterMesuresDetaillees response only the fields used by transform_response
+
+    :param data: consulterMesuresDetaillees response
+    """
+    return {
+        'grandeur': [{
+            'unite': grandeur['unite'],
+            'mesure': [{'d': measure['d'].isoformat(), 'v': measure['v']} for measure in grandeur['mesure']]
+        } for grandeur in data['grandeur']]
+    }
+
+
+def deserialize_response(doc):
+    """ Inverse of serialize_response. Dates are timezone aware datetime as returned by zeep """
+    for grandeur in doc['grandeur']:
+        for measure in grandeur['mesure']:
+            measure['d'] = datetime.fromisoformat(measure['d'])
+
+    return doc
+
+
+class ResponseCache(object):
+    """ Compressed on-disk cache of Enedis responses. Files are addressed by the request: a directory for every
+    point (hashed, PDL is never written) and measures type, and a file for every dates window and request hash.
+    Files are written atomically so it can be shared by every worker. Expired files (ttl) and the oldest ones
+    above max_bytes are removed by evict, which only walks the cache when the size seen on the last walk plus the
+    writes of current process is above max_bytes or when the oldest file seen has expired. Writes of other workers
+    are counted on next walk. In replay mode expired files are still used """
+    # evict leaves the cache at this fraction of max_bytes, so it is not walked again on every write
+    low_watermark = 0.9
+
+    def __init__(self, path=None, ttl=None, max_bytes=None, replay=False):
+        self.path = path or settings.ENEDIS_CACHE_PATH
+        self.ttl = ttl if ttl is not None else settings.ENEDIS_CACHE_TTL
+        self.max_bytes = max_bytes if max_bytes is not None else settings.ENEDIS_CACHE_MAX_BYTES
+        self.replay = replay
+        # size and expiration of the oldest file, unknown until the first walk
+        self._size = None
+        self._expires = None
+        self._lock = threading.Lock()
+
+    def directory(self, body):
+        demande = body['demande']
+        point = hashlib.sha1(demande['pointId'].encode('utf-8')).hexdigest()
+        return os.path.join(self.path, point[:2], point, '%s_%s' % (demande['mesuresTypeCode'], demande['grandeurPhysique']))
+
+    def filename(self, body):
+        demande = body['demande']
+        key = hashlib.sha1(dumps(demande, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory(body), '%s_%s_%s.json.gz' % (demande['dateDebut'], demande['dateFin'], key[:12]))
+
+    def expired(self, filename):
+        return not self.replay and self.ttl and time.time() - os.path.getmtime(filename) > self.ttl
+
+    def read(self, filename):
+        try:
+            if self.expired(filename):
+                return None
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                return deserialize_response(loads(f.read()))
+        except (OSError, ValueError) as e:
+            # missing, removed by another process or corrupted
+            if not isinstance(e, FileNotFoundError):
+                logger.warning('Enedis cache file [%s] cannot be read: %s' % (filename, e))
+            return None
+
+    def get(self, body):
+        """ Returns the cached response for this request or None """
+        return self.read(self.filename(body))
+
+    def put(self, body, data):
+        """ Stores a successful response for this request
+
+        :param body: body sent to Enedis
+        :param data: consulterMesuresDetaillees response
+        """
+        filename = self.filename(body)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                f.write(dumps(serialize_response(data)))
+            size = os.path.getsize(tmp)
+            os.replace(tmp, filename)
+        except OSError as e:
+            logger.warning('Enedis response cannot be cached on [%s]: %s' % (filename, e))
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or (self.max_bytes and self._size > self.max_bytes) or (self._expires and time.time() > self._expires):
+                self.evict()
+
+    def entries(self, body):
+        """ Yields every cached response for the point and measures type of this request, newest first """
+        directory = self.directory(body)
+        try:
+            filenames = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json.gz')]
+        except FileNotFoundError:
+            return
+        filenames.sort(key=lambda filename: os.path.getmtime(filename) if os.path.exists(filename) else 0, reverse=True)
+        for filename in filenames:
+            data = self.read(filename)
+            if data is not None:
+                yield data
+
+    def evict(self):
+        """ Removes expired files and then the oldest ones until cache size is under low_watermark of max_bytes """
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filename))
+
+        now = time.time()
+        total = sum(size for mtime, size, filename in files)
+        removed = 0
+        files.sort()
+        for mtime, size, filename in files:
+            if not (self.ttl and now - mtime > self.ttl) and not (self.max_bytes and total > self.max_bytes * self.low_watermark):
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._size = total
+        self._expires = files[removed][0] + self.ttl if self.ttl and removed < len(files) else None
+        if removed:
+            logger.debug('[%s] files removed from Enedis cache. Cache size: [%s] bytes', removed, total)
+
+
+# responses cache used by get_data on current process
+_cache = None
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
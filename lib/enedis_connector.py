@@ -3,63 +3,153 @@
 # webservice imports
 from requests.auth import HTTPBasicAuth  # or HTTPDigestAuth, or OAuth1, etc.
 from requests import Session
+from requests.exceptions import Timeout, ConnectionError as RequestsConnectionError
 from zeep import Client, Plugin
 from zeep.transports import Transport
+from zeep.exceptions import TransportError
 from lxml import etree
 
 # time imports
 import pytz
 
+import time
+import asyncio
 import logging
-from copy import deepcopy
+import threading
+from copy import copy, deepcopy
+from datetime import datetime
+from itertools import compress
 # custom imports
 import settings
+from lib.ratelimit import get_throttle
+from lib.log import log_payload
+from lib.metrics import metrics
+from lib.cache import get_cache
+from lib.measures import MeasurementBuffer, series_timestamps
 
 logger = logging.getLogger("app")
 
 
+def envelope_to_string(envelope):
+    return etree.tostring(envelope, pretty_print=False)
+
+
 class MyloggerPlugin(Plugin):
+    # envelopes are only serialized on DEBUG, sampled and truncated (see log_payload)
     def ingress(self, envelope, http_headers, operation):
-        # print('Response:')
-        # print(etree.tostring(envelope, pretty_print=False))
-        logger.debug('Enedis response ---------')
-        logger.debug(etree.tostring(envelope, pretty_print=False))    
-        logger.debug('-------------------------')
+        log_payload(logger, 'Enedis response envelope: %s', envelope, envelope_to_string)
         return envelope, http_headers
 
     def egress(self, envelope, http_headers, operation, binding_options):
-        # print('Request:')
-        # print(etree.tostring(envelope, pretty_print=False))
-        logger.debug('Request body: -----------')
-        logger.debug(etree.tostring(envelope, pretty_print=False))    
-        logger.debug('-------------------------')
+        log_payload(logger, 'Enedis request envelope: %s', envelope, envelope_to_string)
         return envelope, http_headers
 
 
+# CDC is a 30 minutes load curve
+CDC_STEP = 30 * 60
+
+SERVICE_BINDING = '{http://www.enedis.fr/sge/b2b/services/consultationmesuresdetaillees/v2.0}AdamConsultationMesuresServiceReadHttpBinding'
+
+
+# WSDL parsed by current process, inherited by forked workers. See load_wsdl_client and load_async_wsdl_client
+_wsdl_client = None
+_async_wsdl_client = None
+_wsdl_lock = threading.Lock()
+
+
+def load_wsdl_client():
+    """ Parses settings.WSDL_PATH and its schemas only once per process. Nothing is kept between executions and
+    spawned workers parse it again, only forked workers inherit it. Returned client must not be used to send
+    requests, every service gets its own copy with its own transport """
+    global _wsdl_client
+    with _wsdl_lock:
+        if _wsdl_client is None:
+            start = time.time()
+            _wsdl_client = Client(settings.WSDL_PATH, transport=Transport(), plugins=[MyloggerPlugin()])
+            logger.debug('WSDL [%s] loaded in [%.2f] seconds', settings.WSDL_PATH, time.time() - start)
+    
+    return _wsdl_client
+
+
 def init_webservice_client():
     """ Creates and initializes Enedis WebService Client"""
     session = Session()
     session.auth = HTTPBasicAuth(settings.ENEDIS_LOGIN_USER, settings.ENEDIS_LOGIN_PASSWORD)
-    client = Client(settings.WSDL_PATH, transport=Transport(session=session), plugins=[MyloggerPlugin()])
+    client = copy(load_wsdl_client())
+    client.transport = Transport(session=session)
 
-    service = client.create_service(
-        '{http://www.enedis.fr/sge/b2b/services/consultationmesuresdetaillees/v2.0}AdamConsultationMesuresServiceReadHttpBinding',
-        settings.ENEDIS_URL or 'https://sge-b2b.enercoop.org/')
+    service = client.create_service(SERVICE_BINDING, settings.ENEDIS_URL or 'https://sge-b2b.enercoop.org/')
     
     return service
 
 
-def get_data(ws_client, customer, measures_type, customer_type, from_date, to_date):
-    """ Function to recover measures from Enedis and transform them into Beedata API documents.
+def load_async_wsdl_client():
+    """ Same than load_wsdl_client for asyncio services. zeep picks binding classes (sync or asyncio) from the transport
+    used while parsing, so asyncio services need their own parsed WSDL. It is also parsed only once per process """
+    global _async_wsdl_client
+    from zeep.asyncio import AsyncTransport
+
+    with _wsdl_lock:
+        if _async_wsdl_client is None:
+            start = time.time()
+            # local WSDL and schemas do not use the loop, it is only needed to create the transport
+            loop = asyncio.new_event_loop()
+            try:
+                transport = AsyncTransport(loop)
+                _async_wsdl_client = Client(settings.WSDL_PATH, transport=transport, plugins=[MyloggerPlugin()])
+                loop.run_until_complete(transport.session.close())
+            finally:
+                loop.close()
+            logger.debug('WSDL [%s] loaded for asyncio client in [%.2f] seconds', settings.WSDL_PATH, time.time() - start)
     
-    :param ws_client: Enedis webservice client
-    :param customer: Contract full dictionary from get_contracts function
+    return _async_wsdl_client
+
+
+async def init_async_webservice_client():
+    """ Creates an asyncio Enedis WebService Client on current event loop. Service operations return coroutines.
+    
+    :return (service, session) tuple. aiohttp session has to be closed by the caller once all requests are done
+    """
+    import aiohttp
+    from zeep.asyncio import AsyncTransport
+
+    session = aiohttp.ClientSession(
+        auth=aiohttp.BasicAuth(settings.ENEDIS_LOGIN_USER, settings.ENEDIS_LOGIN_PASSWORD),
+        connector=aiohttp.TCPConnector(limit=settings.ENEDIS_ASYNC_CONCURRENCY))
+    # parsing uses its own event loop, so it is done outside the running one
+    loop = asyncio.get_event_loop()
+    client = copy(await loop.run_in_executor(None, load_async_wsdl_client))
+    client.transport = AsyncTransport(loop, session=session)
+
+    service = client.create_service(SERVICE_BINDING, settings.ENEDIS_URL or 'https://sge-b2b.enercoop.org/')
+    
+    return service, session
+
+
+class LazyWebserviceClient(object):
+    """ Enedis WebService Client created on first use, so processes that do not recover measures never load the WSDL """
+    def __init__(self):
+        self._service = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._service = init_webservice_client()
+        
+        return getattr(self._service, name)
+
+
+def build_request(customer, measures_type, from_date, to_date):
+    """ Creates consulterMesuresDetaillees body to recover measures from Enedis.
+    
+    :param customer: Contract full dictionary from iter_contracts function
     :param measures_type: one of PMAX, CDC, CONSOGLO
-    :param customer_type: one of residential or tertiary
     :param from_date: where request start
     :param to_date: where request finish
     """
-    logger.debug('Preparing body to recover [%s] measures from Enedis service for contract [%s]...' % (measures_type, customer['document']['contractId']))
+    logger.debug('Preparing body to recover [%s] measures from Enedis service for contract [%s]...', measures_type, customer['document']['contractId'])
     body = {
         'demande': {
             'initiateurLogin': settings.ENEDIS_INIT_LOGIN_MAIL,
@@ -82,19 +172,111 @@ def get_data(ws_client, customer, measures_type, customer_type, from_date, to_da
     else:  # consoglo
         body['demande']['grandeurPhysique'] = 'EA'
 
-    logger.debug('Body data: %s' % body)
-    data = None
-    error = None
-    try:
-        data = ws_client.consulterMesuresDetaillees(**body)
-        logger.debug('Measures recovered successfully from Enedis for contract [%s]: %s' % (customer['document']['contractId'], data))
-    except Exception as e:
-        clean_body = deepcopy(body)
-        del clean_body['demande']['pointId']
-        del clean_body['demande']['initiateurLogin']
-        logger.warning('Cannot recover data from Enedis for contract [%s]: %s. Data sent to Enedis: %s' % (customer['document']['contractId'], e, clean_body))
-        error = str(e)
+    logger.debug('Body data: %s', body)
+    
+    return body
+
+
+def request_error(customer, body, e):
+    """ Logs an Enedis request failure and returns its error message
+    
+    :param customer: Contract full dictionary from iter_contracts function
+    :param body: body sent to Enedis
+    :param e: exception raised
+    """
+    clean_body = deepcopy(body)
+    del clean_body['demande']['pointId']
+    del clean_body['demande']['initiateurLogin']
+    logger.warning('Cannot recover data from Enedis for contract [%s]: %s. Data sent to Enedis: %s' % (customer['document']['contractId'], e, clean_body))
+    
+    return str(e)
+
+
+def is_overload_error(e):
+    """ True if the exception means Enedis service is throttling us or overloaded (not a business error for this request)
+    
+    :param e: exception raised by the service call
+    """
+    if isinstance(e, TransportError):
+        return e.status_code in settings.ENEDIS_THROTTLE_STATUS
+    
+    return isinstance(e, (Timeout, RequestsConnectionError))
+
+
+def call_service(ws_client, body):
+    """ Calls consulterMesuresDetaillees through the shared rate limiter and concurrency controller.
+    Requests rejected because the service is overloaded are retried with exponential backoff
+    
+    :param ws_client: Enedis webservice client
+    :param body: body to send
+    """
+    throttle = get_throttle()
+    attempt = 0
+    while True:
+        start = throttle.acquire() if throttle else None
+        try:
+            data = ws_client.consulterMesuresDetaillees(**body)
+        except Exception as e:
+            time.sleep(retry_delay(throttle, start, e, attempt))
+            attempt += 1
+        else:
+            if throttle:
+                throttle.release(start, True)
+            return data
+
+
+async def async_call_service(ws_client, body):
+    """ Coroutine version of call_service for init_async_webservice_client services. Throttle is shared with other
+    processes and blocks, so it is waited on the event loop executor
+    
+    :param ws_client: Enedis asyncio webservice client
+    :param body: body to send
+    """
+    throttle = get_throttle()
+    loop = asyncio.get_event_loop()
+    attempt = 0
+    while True:
+        start = await loop.run_in_executor(None, throttle.acquire) if throttle else None
+        try:
+            data = await ws_client.consulterMesuresDetaillees(**body)
+        except Exception as e:
+            await asyncio.sleep(retry_delay(throttle, start, e, attempt))
+            attempt += 1
+        else:
+            if throttle:
+                throttle.release(start, True)
+            return data
+
 
+def retry_delay(throttle, start, e, attempt):
+    """ Frees the throttle slot of a failed request and returns seconds to wait before retrying it.
+    The exception is raised again if it was not caused by an overloaded service or there are no retries left
+    
+    :param throttle: shared throttle or None
+    :param start: value returned by throttle acquire
+    :param e: exception raised by the request
+    :param attempt: number of retries already done
+    """
+    overloaded = is_overload_error(e)
+    if throttle:
+        throttle.release(start, not overloaded)
+    if not overloaded or attempt >= settings.ENEDIS_THROTTLE_RETRIES:
+        raise e
+    wait = settings.ENEDIS_THROTTLE_BACKOFF * 2 ** attempt
+    metrics.inc('enedis_retries_total')
+    logger.info('Enedis service overloaded (%s). Retrying in [%s] seconds...' % (e, wait))
+    
+    return wait
+
+
+def transform_response(data, customer, measures_type, error=None):
+    """ Transforms Enedis measures response into Beedata API document.
+    
+    :param data: consulterMesuresDetaillees response or None
+    :param customer: Contract full dictionary from iter_contracts function
+    :param measures_type: one of PMAX, CDC, CONSOGLO
+    :param error: error message if request failed
+    """
     doc = None
     if data:
         type_ = None
@@ -115,18 +297,27 @@ def get_data(ws_client, customer, measures_type, customer_type, from_date, to_da
                         'period': 'INSTANT',
                         'unit': grandeur['unite'] if measures_type != 'CDC' else 'Wh'
                     }],
-                    'measurements': []
+                    'measurements': MeasurementBuffer(type_)
                 }
             
-            for measure in grandeur['mesure']:
-                if measure['v'] is not None:
-                    doc['measurements'].append({
-                        'type': type_,
-                        'timestamp': measure['d'].astimezone(pytz.utc).strftime(settings.DATETIME_FORMAT),
-                        'value': int(int(measure['v']) * 0.5) if measures_type == 'CDC' else int(measure['v'])
-                    })
-                else:
-                    logger.warning('Enedis measurment for contract [%s] on timestamp [%s] is null' % (customer['document']['contractId'], measure['d'].astimezone(pytz.utc).strftime(settings.DATETIME_FORMAT)))
+            # whole series is converted at once: CDC epochs are computed from the first point, null values are only counted
+            mesures = grandeur['mesure']
+            timestamps = series_timestamps([measure['d'] for measure in mesures], CDC_STEP if measures_type == 'CDC' else None)
+            values = [measure['v'] for measure in mesures]
+            present = [value is not None for value in values]
+            nulls = len(present) - sum(present)
+            if nulls:
+                timestamps = list(compress(timestamps, present))
+                values = list(compress(values, present))
+            if measures_type == 'CDC':
+                values = [int(int(value) * 0.5) for value in values]
+            else:
+                values = list(map(int, values))
+            doc['measurements'].extend_columns(timestamps, values)
+            
+            if nulls:
+                null_dates = [measure['d'] for measure in grandeur['mesure'] if measure['v'] is None]
+                logger.warning('[%s] Enedis measurements for contract [%s] are null between [%s] and [%s]' % (nulls, customer['document']['contractId'], min(null_dates).astimezone(pytz.utc).strftime(settings.DATETIME_FORMAT), max(null_dates).astimezone(pytz.utc).strftime(settings.DATETIME_FORMAT)))
 
         if len(doc['measurements']) == 0:
             return {'error': 'All measures for contract [%s] are null' % customer['document']['contractId']}
@@ -134,3 +325,116 @@ def get_data(ws_client, customer, measures_type, customer_type, from_date, to_da
         return doc
 
     return {'error': error}
+
+
+def get_data(ws_client, customer, measures_type, customer_type, from_date, to_date):
+    """ Function to recover measures from Enedis and transform them into Beedata API documents.
+    
+    :param ws_client: Enedis webservice client
+    :param customer: Contract full dictionary from iter_contracts function
+    :param measures_type: one of PMAX, CDC, CONSOGLO
+    :param customer_type: one of residential or tertiary
+    :param from_date: where request start
+    :param to_date: where request finish
+    """
+    body = build_request(customer, measures_type, from_date, to_date)
+    result = get_cached_result(body, customer, measures_type)
+    if result is not None:
+        return result
+    
+    data = None
+    error = None
+    with metrics.timer('enedis_request_seconds', type=measures_type) as labels:
+        try:
+            data = call_service(ws_client, body)
+            labels['outcome'] = 'ok'
+            logger.debug('Measures recovered successfully from Enedis for contract [%s]', customer['document']['contractId'])
+            log_payload(logger, 'Enedis response: %s', data)
+        except Exception as e:
+            labels['outcome'] = 'error'
+            error = request_error(customer, body, e)
+
+    return store_result(body, data, customer, measures_type, error)
+
+
+async def async_get_data(ws_client, customer, measures_type, customer_type, from_date, to_date):
+    """ Coroutine version of get_data to be used with init_async_webservice_client service.
+    
+    :param ws_client: Enedis asyncio webservice client
+    :param customer: Contract full dictionary from iter_contracts function
+    :param measures_type: one of PMAX, CDC, CONSOGLO
+    :param customer_type: one of residential or tertiary
+    :param from_date: where request start
+    :param to_date: where request finish
+    """
+    body = build_request(customer, measures_type, from_date, to_date)
+    result = get_cached_result(body, customer, measures_type)
+    if result is not None:
+        return result
+    
+    data = None
+    error = None
+    with metrics.timer('enedis_request_seconds', type=measures_type) as labels:
+        try:
+            data = await async_call_service(ws_client, body)
+            labels['outcome'] = 'ok'
+            logger.debug('Measures recovered successfully from Enedis for contract [%s]', customer['document']['contractId'])
+            log_payload(logger, 'Enedis response: %s', data)
+        except Exception as e:
+            labels['outcome'] = 'error'
+            error = request_error(customer, body, e)
+
+    return store_result(body, data, customer, measures_type, error)
+
+
+def get_cached_result(body, customer, measures_type):
+    """ Returns Beedata API document built from the cached response for this request or None if it is not cached """
+    cache = get_cache()
+    data = cache.get(body) if cache else None
+    if data is None:
+        return None
+    logger.debug('Measures recovered from Enedis cache for contract [%s]', customer['document']['contractId'])
+    metrics.inc('enedis_cache_total', type=measures_type, outcome='hit')
+    with metrics.timer('enedis_transform_seconds', type=measures_type):
+        return transform_response(data, customer, measures_type)
+
+
+def store_result(body, data, customer, measures_type, error=None):
+    """ Caches a successful Enedis response and returns its Beedata API document (or the error) """
+    cache = get_cache()
+    if cache and data:
+        cache.put(body, data)
+
+    with metrics.timer('enedis_transform_seconds', type=measures_type):
+        return transform_response(data, customer, measures_type, error)
+
+
+def get_cached_data(customer, measures_type):
+    """ Rebuilds Beedata API document from every Enedis response cached for this contract and measures type,
+    without any request to Enedis (replay mode). Newest responses win when windows overlap
+    
+    :param customer: Contract full dictionary from iter_contracts function
+    :param measures_type: one of PMAX, CDC, CONSOGLO
+    """
+    body = build_request(customer, measures_type, datetime.now(), datetime.now())
+    doc = None
+    seen = set()
+    for data in get_cache().entries(body):
+        result = transform_response(data, customer, measures_type)
+        if 'error' in result:
+            continue
+        if doc is None:
+            doc = result
+            measurements = result['measurements']
+            doc['measurements'] = MeasurementBuffer(measurements.type)
+        else:
+            measurements = result['measurements']
+        for timestamp, value in zip(measurements.timestamps, measurements.values):
+            if timestamp not in seen:
+                seen.add(timestamp)
+                doc['measurements'].append(timestamp, value)
+    
+    if doc is None:
+        return {'error': 'No Enedis responses cached for contract [%s] and type [%s]' % (customer['document']['contractId'], measures_type)}
+    
+    return doc
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+# utils imports
+import os
+import logging
+from json import dumps, loads
+from datetime import datetime
+
+# custom imports
+import settings
+
+logger = logging.getLogger("app")
+
+# unit recorded once every measure type of a contract has been processed
+CONTRACT_UNIT = 'CONTRACT'
+
+
+def unit_key(measure_type, direction=None, window=None):
+    """ Name of a unit of work of a contract: a whole measure type, a PMAX or CONSOGLO direction or a CDC window
+
+    :param measure_type: one of PMAX, CDC, CONSOGLO
+    :param direction: backward or forward
+    :param window: (from_date, to_date) tuple
+    """
+    parts = [measure_type]
+    if direction:
+        parts.append(direction)
+    if window:
+        parts.extend(date.strftime('%Y-%m-%d') for date in window)
+
+    return '/'.join(parts)
+
+
+class Journal(object):
+    """ Append-only journal of completed units of work, one JSON line per unit. Lines are small enough to be
+    written with a single system call, so every worker appends to the same file without locks """
+    def __init__(self, path=None, truncate=False):
+        self.path = path or settings.JOURNAL_PATH
+        self.file = open(self.path, 'w' if truncate else 'a', encoding='utf-8')
+
+    def record(self, id, unit):
+        """ Records a completed unit of work
+
+        :param id: contractId
+        :param unit: unit_key or CONTRACT_UNIT
+        """
+        self.file.write(dumps({'contractId': id, 'unit': unit, 'at': datetime.now().strftime(settings.DATETIME_FORMAT)}) + '\n')
+        self.file.flush()
+        if settings.JOURNAL_FSYNC:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def load_journal(path=None):
+    """ Returns completed units by contractId recorded on a journal. Last line is ignored if it was not fully written
+
+    :param path: journal path. Default to settings.JOURNAL_PATH
+    """
+    completed = {}
+    path = path or settings.JOURNAL_PATH
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = loads(line)
+            except ValueError:
+                continue
+            completed.setdefault(item['contractId'], set()).add(item['unit'])
+    logger.info('[%s] contracts found on journal [%s]' % (len(completed), path))
+
+    return completed
+
+
+def iter_pending(contracts, completed):
+    """ Skips contracts already processed and adds completed units of the others on journal field
+
+    :param contracts: iterator of (contractId, data) tuples as yielded by iter_contracts
+    :param completed: dict returned by load_journal
+    """
+    skipped = 0
+    for id, data in contracts:
+        units = completed.get(id)
+        if units and CONTRACT_UNIT in units:
+            skipped += 1
+            continue
+        if units:
+            data['journal'] = units
+        yield id, data
+    logger.info('[%s] contracts already processed were skipped' % skipped)
+
+
+# journal used by process_contract on current process
+_journal = None
+
+
+def set_journal(journal):
+    global _journal
+    _journal = journal
+
+
+def get_journal():
+    return _journal
@@ -1,7 +1,84 @@
 import re
 import ast
 import csv
+import logging
 import argparse
+from itertools import count
+
+# big payloads dumps on DEBUG, see log_payload
+_payloads = {'sample': 1, 'max_chars': 0}
+_payload_counter = count()
+
+
+def setup_logger(loglevel, log_file, mode='w', payload_sample=1, payload_max_chars=0):
+    """ Configures app logger to output to log_file and CLI
+
+    :param loglevel: one of DEBUG, INFO, WARNING or ERROR
+    :param log_file: .log file path
+    :param mode: log file open mode
+    :param payload_sample: only one of every payload_sample payloads is logged by log_payload
+    :param payload_max_chars: max length of payloads logged by log_payload (0 for no limit)
+    """
+    _payloads['sample'] = max(1, payload_sample)
+    _payloads['max_chars'] = payload_max_chars
+    loglevel = loglevel.upper()
+    numeric_level = getattr(logging, loglevel, None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % loglevel)
+    logger = logging.getLogger("app")
+    logger.setLevel(numeric_level)
+    formatter = logging.Formatter('PID [%(process)d] - %(asctime)s - %(levelname)s - %(message)s')
+
+    # File handler to output to .log file
+    ch = logging.FileHandler(log_file, mode, 'utf-8')
+    ch.setLevel(numeric_level)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    # Stream handler to output to CLI
+    sh = logging.StreamHandler()
+    sh.setLevel(numeric_level)
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+    logging.getLogger("zeep").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    return logger
+
+
+class Payload(object):
+    """ Serializes a value only when the log record is emitted, truncated to max_chars """
+    def __init__(self, value, serializer=str, max_chars=0):
+        self.value = value
+        self.serializer = serializer
+        self.max_chars = max_chars
+        self._text = None
+
+    def __str__(self):
+        # formatted once for every handler
+        if self._text is None:
+            text = self.serializer(self.value)
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', 'replace')
+            if self.max_chars and len(text) > self.max_chars:
+                text = '%s... [%s chars truncated]' % (text[:self.max_chars], len(text) - self.max_chars)
+            self._text = text
+
+        return self._text
+
+
+def log_payload(logger, message, value, serializer=str):
+    """ Logs a big value (documents, SOAP envelopes...) on DEBUG. Nothing is serialized if DEBUG is disabled,
+    only one of every payload_sample payloads is logged and it is truncated to payload_max_chars (see setup_logger)
+
+    :param logger: logger to use
+    :param message: message with a single %s placeholder for the value
+    :param value: value to log
+    :param serializer: function to convert value into text
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or next(_payload_counter) % _payloads['sample']:
+        return
+    logger.debug(message, Payload(value, serializer, _payloads['max_chars']))
 
 
 def process_log(filename):
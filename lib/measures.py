@@ -0,0 +1,205 @@
+# encoding: utf-8
+
+# utils imports
+from array import array
+from json import dumps
+from operator import sub
+from datetime import datetime, timedelta
+
+# custom imports
+import settings
+
+
+# directives of DATETIME_FORMAT depending on the time of day (the rest only depend on the day)
+TIME_DIRECTIVES = ['%H', '%I', '%M', '%S', '%p', '%f']
+
+
+def format_timestamp(timestamp):
+    """ Formats epoch seconds (UTC) as settings.DATETIME_FORMAT string
+
+    :param timestamp: epoch seconds or None
+    """
+    if timestamp is None:
+        return None
+
+    return datetime.utcfromtimestamp(timestamp).strftime(settings.DATETIME_FORMAT)
+
+
+def split_format(datetime_format):
+    """ Splits a datetime format into its date and time of day parts, or returns None if they are mixed """
+    positions = [datetime_format.find(directive) for directive in TIME_DIRECTIVES if directive in datetime_format]
+    if not positions:
+        return None
+    date_part = datetime_format[:min(positions)]
+    time_part = datetime_format[min(positions):]
+    if '%' in time_part.replace('%%', '').replace('%H', '').replace('%I', '').replace('%M', '').replace('%S', '').replace('%p', '').replace('%f', ''):
+        return None
+
+    return date_part, time_part
+
+
+def format_timestamps(timestamps):
+    """ Formats a series of epoch seconds (UTC) as settings.DATETIME_FORMAT strings. Date part is formatted once per
+    day and time part once per time of day, so no datetime is created per point
+
+    :param timestamps: iterable of epoch seconds
+
+    :return list of strings
+    """
+    parts = split_format(settings.DATETIME_FORMAT)
+    if parts is None:
+        return [format_timestamp(timestamp) for timestamp in timestamps]
+
+    date_part, time_part = parts
+    days = {}
+    times = {}
+    formatted = []
+    for timestamp in timestamps:
+        day, seconds = divmod(timestamp, 86400)
+        date = days.get(day)
+        if date is None:
+            date = days[day] = datetime.utcfromtimestamp(day * 86400).strftime(date_part)
+        time = times.get(seconds)
+        if time is None:
+            time = times[seconds] = datetime.utcfromtimestamp(seconds).strftime(time_part)
+        formatted.append(date + time)
+
+    return formatted
+
+
+def series_timestamps(dates, step=None):
+    """ Converts a series of timezone aware datetime into epoch seconds. If every point is step seconds after the
+    previous one (Enedis load curves without missing points) epochs are computed from the first point without
+    converting the others, otherwise they are converted one by one
+
+    :param dates: list of datetime
+    :param step: expected seconds between points, None if the series is not regular
+
+    :return sequence of epoch seconds
+    """
+    if not dates:
+        return []
+    first = int(dates[0].timestamp())
+    if step and set(map(sub, dates[1:], dates[:-1])) <= {timedelta(seconds=step)}:
+        return range(first, first + len(dates) * step, step)
+
+    return [int(date.timestamp()) for date in dates]
+
+
+class MeasurementBuffer(object):
+    """ Columnar storage for measurements of a single type. Timestamps (epoch seconds, UTC) and values are kept
+    in arrays and the type is stored once. Beedata measurements list is only created when it is serialized.
+    First and last timestamps are tracked while measurements are added """
+    def __init__(self, type_):
+        self.type = type_
+        self.timestamps = array('q')
+        self.values = array('q')
+        self.ts_min = None
+        self.ts_max = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for timestamp, value in zip(format_timestamps(self.timestamps), self.values):
+            yield {
+                'type': self.type,
+                'timestamp': timestamp,
+                'value': value
+            }
+
+    def append(self, timestamp, value):
+        """ Adds a single measurement
+
+        :param timestamp: epoch seconds (UTC)
+        :param value: integer value
+        """
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        if self.ts_min is None or timestamp < self.ts_min:
+            self.ts_min = timestamp
+        if self.ts_max is None or timestamp > self.ts_max:
+            self.ts_max = timestamp
+
+    def extend_columns(self, timestamps, values):
+        """ Adds a whole series of measurements at once
+
+        :param timestamps: sequence of epoch seconds (UTC)
+        :param values: sequence of integer values, same length than timestamps
+        """
+        if not timestamps:
+            return
+        self.timestamps.extend(timestamps)
+        self.values.extend(values)
+        ts_min = min(timestamps)
+        ts_max = max(timestamps)
+        if self.ts_min is None or ts_min < self.ts_min:
+            self.ts_min = ts_min
+        if self.ts_max is None or ts_max > self.ts_max:
+            self.ts_max = ts_max
+
+    def extend(self, other):
+        """ Adds every measurement from another buffer
+
+        :param other: MeasurementBuffer of the same type
+        """
+        if not len(other):
+            return
+        self.timestamps.extend(other.timestamps)
+        self.values.extend(other.values)
+        if self.ts_min is None or other.ts_min < self.ts_min:
+            self.ts_min = other.ts_min
+        if self.ts_max is None or other.ts_max > self.ts_max:
+            self.ts_max = other.ts_max
+
+    def min_timestamp(self):
+        """ First measurement timestamp formatted as settings.DATETIME_FORMAT or None if buffer is empty """
+        return format_timestamp(self.ts_min)
+
+    def max_timestamp(self):
+        """ Last measurement timestamp formatted as settings.DATETIME_FORMAT or None if buffer is empty """
+        return format_timestamp(self.ts_max)
+
+
+def iter_measures_chunks(doc, max_count, max_bytes, reverse=False):
+    """ Splits measures document built by get_data into JSON bodies ready to be sent to Beedata.
+    Measurements are sorted by timestamp and every body has at most max_count of them and about max_bytes size.
+    Only one body is kept in memory at a time. Timestamps are formatted in batch (see format_timestamps)
+
+    :param doc: document with a MeasurementBuffer on measurements field
+    :param max_count: max measurements per body
+    :param max_bytes: max body size in bytes (a body always has at least one measurement)
+    :param reverse: True to yield newest measurements first
+
+    :return generator of (body, count, ts_min, ts_max) tuples, timestamps as epoch seconds
+    """
+    buffer = doc['measurements']
+    header = dumps(dict((k, v) for k, v in doc.items() if k != 'measurements'))
+    prefix = (header[:-1] + (', ' if len(header) > 2 else '') + '"measurements": [').encode('utf-8')
+    suffix = b']}'
+    # same output than dumps of every measurement dict
+    template = '{"type": %s, "timestamp": %%s, "value": %%d}' % dumps(buffer.type).replace('%', '%%')
+    
+    order = sorted(range(len(buffer)), key=buffer.timestamps.__getitem__, reverse=reverse)
+    timestamps = [buffer.timestamps[index] for index in order]
+    formatted = format_timestamps(timestamps)
+    items = []
+    size = len(prefix) + len(suffix)
+    first = None
+    last = None
+    for position, index in enumerate(order):
+        timestamp = timestamps[position]
+        item = (template % (dumps(formatted[position]), buffer.values[index])).encode('utf-8')
+        if items and (len(items) >= max_count or size + len(item) + 2 > max_bytes):
+            yield prefix + b', '.join(items) + suffix, len(items), min(first, last), max(first, last)
+            items = []
+            size = len(prefix) + len(suffix)
+            first = None
+        if first is None:
+            first = timestamp
+        items.append(item)
+        size += len(item) + 2
+        last = timestamp
+    
+    if items:
+        yield prefix + b', '.join(items) + suffix, len(items), min(first, last), max(first, last)
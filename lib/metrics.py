@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+# utils imports
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# custom imports
+import settings
+
+logger = logging.getLogger("app")
+
+
+class Metrics(object):
+    """ Counters and latency histograms labeled by stage, measure type, outcome... of current process.
+    Workers send what they recorded to the parent with every result (collect) and the parent adds it (merge) """
+    def __init__(self, buckets=None):
+        self.buckets = buckets or settings.METRICS_BUCKETS
+        self.counters = {}
+        self.histograms = {}
+        # seconds by histogram name since last pop_stages, stages breakdown of the contract being processed
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """ Increases a counter
+
+        :param name: metric name
+        :param value: amount to add
+        :param labels: metric labels
+        """
+        key = self.key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Adds a duration to a histogram
+
+        :param name: metric name
+        :param seconds: observed duration
+        :param labels: metric labels
+        """
+        key = self.key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observes the duration of the block. Labels can be changed inside it (outcome is usually known at the end)
+
+        :param name: metric name
+        :param labels: metric labels
+        """
+        start = time.time()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def collect(self):
+        """ Returns everything recorded since last collect and resets it """
+        with self._lock:
+            snapshot = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+
+        return snapshot
+
+    def pop_stages(self):
+        """ Returns seconds observed by histogram name since last call and resets them """
+        with self._lock:
+            stages = self.stages
+            self.stages = {}
+
+        return stages
+
+    def merge(self, snapshot):
+        """ Adds a snapshot returned by collect on another process """
+        counters, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def quantile(self, key, q):
+        """ Estimated quantile of a histogram (upper bound of the bucket containing it) """
+        buckets, total, count = self.histograms[key]
+        rank = q * count
+        accumulated = 0
+        for bound, n in zip(self.buckets + [float('inf')], buckets):
+            accumulated += n
+            if accumulated >= rank:
+                return bound
+
+    def to_prometheus(self):
+        """ Returns every metric in Prometheus text exposition format """
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+        prefix = settings.METRICS_PREFIX
+        lines = []
+        with self._lock:
+            for name in sorted(set(name for name, labels in self.counters)):
+                lines.append('# TYPE %s%s counter' % (prefix, name))
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append('%s%s%s %s' % (prefix, name, format_labels(labels), value))
+            for name in sorted(set(name for name, labels in self.histograms)):
+                lines.append('# TYPE %s%s histogram' % (prefix, name))
+                for (metric, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    accumulated = 0
+                    for bound, n in zip(self.buckets + ['+Inf'], buckets):
+                        accumulated += n
+                        lines.append('%s%s_bucket%s %s' % (prefix, name, format_labels(labels, [('le', bound)]), accumulated))
+                    lines.append('%s%s_sum%s %s' % (prefix, name, format_labels(labels), total))
+                    lines.append('%s%s_count%s %s' % (prefix, name, format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """ Writes metrics in Prometheus text format (node_exporter textfile collector) """
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def log_summary(self):
+        """ Logs count, total, mean and estimated p50/p95 of every histogram and every counter """
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for key, (buckets, total, count) in histograms:
+            name, labels = key
+            logger.info('Metric [%s] %s: count [%s], total [%.1f]s, mean [%.3f]s, p50 <= [%s]s, p95 <= [%s]s'
+                        % (name, dict(labels), count, total, total / count if count else 0, self.quantile(key, 0.5), self.quantile(key, 0.95)))
+        for (name, labels), value in counters:
+            logger.info('Metric [%s] %s: [%s]' % (name, dict(labels), value))
+
+
+# metrics of current process
+metrics = Metrics()
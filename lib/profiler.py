@@ -0,0 +1,144 @@
+# encoding: utf-8
+
+# utils imports
+import os
+import glob
+import heapq
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+# custom imports
+import settings
+
+logger = logging.getLogger("app")
+
+
+class Profiler(object):
+    """ cProfile of the contracts processed by current process. cProfile only sees the thread where it is enabled,
+    so every thread (contract consumer, measures producers and Enedis windows fetchers) is profiled on its own.
+    Each profile is added to the process stats when its block ends, which are dumped to path/profile_<pid>.prof
+    when the process exits """
+    def __init__(self, path):
+        self.path = path
+        self.stats = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profiling(self):
+        """ Profiles the block on current thread. Nested blocks are profiled by the outer one """
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            try:
+                yield
+            finally:
+                local.depth -= 1
+            return
+
+        profile = cProfile.Profile()
+        local.depth = 1
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            local.depth = 0
+            # threads are short lived, so their profiles are not kept once added
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def dump(self):
+        """ Writes the stats of every thread of this process on a single file """
+        with self._lock:
+            stats = self.stats
+            self.stats = None
+        if stats is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, 'profile_%s.prof' % os.getpid())
+        stats.dump_stats(filename)
+        logger.debug('Profile written to [%s]', filename)
+
+
+# profiler of current process, None when --profile is not used
+_profiler = None
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def profiled():
+    """ Profiles the block (or decorated function) if current process is being profiled """
+    if _profiler is None:
+        yield
+        return
+    with _profiler.profiling():
+        yield
+
+
+class SlowestContracts(object):
+    """ Keeps the n slowest contracts with the time spent on every stage (histogram names of lib.metrics) """
+    def __init__(self, n=None):
+        self.n = n or settings.PROFILE_TOP_CONTRACTS
+        self._heap = []
+
+    def add(self, id, result):
+        """ Adds a contract result returned by process_contract with its stages breakdown """
+        if not result.get('start') or not result.get('finish'):
+            return
+        item = ((result['finish'] - result['start']).total_seconds(), id, result.get('stages') or {})
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, item)
+        elif item[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def items(self):
+        """ Returns (seconds, contractId, stages) tuples, slowest first """
+        return sorted(self._heap, key=lambda item: item[0], reverse=True)
+
+
+def format_stages(stages):
+    return ', '.join('%s: %.2fs' % (name.replace('_seconds', ''), seconds) for name, seconds in sorted(stages.items(), key=lambda stage: -stage[1]))
+
+
+def write_profile_report(path, slowest, top=None):
+    """ Merges the profiles dumped by every process on path into path/merged.prof and writes path/report.txt with
+    the slowest contracts and the functions with highest cumulative and own time
+
+    :param path: directory where processes dumped their profiles
+    :param slowest: SlowestContracts
+    :param top: number of functions listed. Default to settings.PROFILE_TOP_FUNCTIONS
+
+    :return report path
+    """
+    top = top or settings.PROFILE_TOP_FUNCTIONS
+    os.makedirs(path, exist_ok=True)
+    filenames = sorted(glob.glob(os.path.join(path, 'profile_*.prof')))
+    report = os.path.join(path, 'report.txt')
+    with open(report, 'w', encoding='utf-8') as f:
+        f.write('Slowest contracts (stages may overlap, measures are recovered and uploaded concurrently)\n\n')
+        for seconds, id, stages in slowest.items():
+            logger.info('Slow contract [%s]: [%.1f] seconds. %s' % (id, seconds, format_stages(stages)))
+            f.write('%10.2fs  %s  %s\n' % (seconds, id, format_stages(stages)))
+        f.write('\nProfiles merged from [%s] processes\n\n' % len(filenames))
+        if filenames:
+            stats = pstats.Stats(*filenames, stream=f)
+            stats.dump_stats(os.path.join(path, 'merged.prof'))
+            stats.sort_stats('cumulative').print_stats(top)
+            stats.sort_stats('tottime').print_stats(top)
+
+    return report
@@ -0,0 +1,116 @@
+# encoding: utf-8
+
+# utils imports
+import time
+import logging
+import multiprocessing
+
+logger = logging.getLogger("app")
+
+
+class TokenBucket(object):
+    """ Token bucket limiter. Its state lives in shared memory so every worker it is passed to uses the same budget """
+    def __init__(self, rate, capacity=None, context=None):
+        context = context or multiprocessing
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._lock = context.Lock()
+        self._tokens = context.Value('d', self.capacity, lock=False)
+        self._updated = context.Value('d', time.time(), lock=False)
+
+    def reserve(self):
+        """ Takes a token and returns how many seconds the caller has to wait before using it """
+        with self._lock:
+            now = time.time()
+            tokens = min(self.capacity, self._tokens.value + (now - self._updated.value) * self.rate) - 1
+            self._tokens.value = tokens
+            self._updated.value = now
+
+        return max(0.0, -tokens / self.rate)
+
+    def acquire(self):
+        """ Blocks until a token is available """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class ConcurrencyController(object):
+    """ AIMD controller for the number of requests in flight shared by every process.
+    Limit grows by one after a full limit of successful requests under latency target
+    and it is multiplied by decrease factor on errors or slow requests (once per cooldown) """
+    def __init__(self, initial, minimum, maximum, latency_target, decrease_factor=0.5, cooldown=1.0, context=None):
+        context = context or multiprocessing
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._condition = context.Condition()
+        self._limit = context.Value('d', initial, lock=False)
+        self._in_flight = context.Value('i', 0, lock=False)
+        self._successes = context.Value('i', 0, lock=False)
+        self._last_decrease = context.Value('d', 0.0, lock=False)
+
+    @property
+    def limit(self):
+        return int(self._limit.value)
+
+    def acquire(self):
+        """ Blocks until the number of requests in flight is under current limit """
+        with self._condition:
+            while self._in_flight.value >= int(self._limit.value):
+                self._condition.wait()
+            self._in_flight.value += 1
+
+    def release(self, ok, latency):
+        """ Frees a slot and adjusts limit with the request outcome
+
+        :param ok: False if the service was overloaded (throttling, timeouts...)
+        :param latency: request time in seconds
+        """
+        with self._condition:
+            self._in_flight.value -= 1
+            if not ok or latency > self.latency_target:
+                now = time.time()
+                if now - self._last_decrease.value > self.cooldown:
+                    self._limit.value = max(self.minimum, self._limit.value * self.decrease_factor)
+                    self._last_decrease.value = now
+                    logger.debug('Enedis concurrency limit decreased to [%s] (ok: %s, latency: %.2fs)', self.limit, ok, latency)
+                self._successes.value = 0
+            else:
+                self._successes.value += 1
+                if self._successes.value >= int(self._limit.value) and self._limit.value < self.maximum:
+                    self._limit.value = min(self.maximum, self._limit.value + 1)
+                    self._successes.value = 0
+                    logger.debug('Enedis concurrency limit increased to [%s]', self.limit)
+            self._condition.notify_all()
+
+
+class Throttle(object):
+    """ Rate limit and adaptive concurrency applied to every Enedis request. Shared objects are created with the
+    multiprocessing context (start method) used by the workers """
+    def __init__(self, rate, initial, minimum, maximum, latency_target, context=None):
+        self.bucket = TokenBucket(rate, context=context)
+        self.controller = ConcurrencyController(initial, minimum, maximum, latency_target, context=context)
+
+    def acquire(self):
+        self.controller.acquire()
+        self.bucket.acquire()
+        return time.time()
+
+    def release(self, start, ok):
+        self.controller.release(ok, time.time() - start)
+
+
+# throttle shared by every get_data call. It is passed to workers on init_worker
+_throttle = None
+
+
+def set_throttle(throttle):
+    global _throttle
+    _throttle = throttle
+
+
+def get_throttle():
+    return _throttle
@@ -1,39 +1,128 @@
 # encoding: utf-8
 
 # utils imports
+import os
+import logging
+from json import dumps
 from datetime import datetime
+from pymongo.errors import PyMongoError
 
-class Report(object):
-    
+# custom imports
+import settings
+
+logger = logging.getLogger("app")
+
+
+class MongoReportWriter(object):
+    """ Report summary is a document of Reports collection and contract results are documents of its
+    results sub-collection (Reports.results) with the report id """
     def __init__(self, mongo_db, collection='Reports'):
         self.mongo_db = mongo_db
         self.collection = self.mongo_db[collection]
+        self.results = self.mongo_db['%s.results' % collection]
+        self.id = None
+
+    def write(self, results):
+        if not self.id:
+            return
+        for result in results:
+            result['report_id'] = self.id
+        try:
+            self.results.insert_many(results, ordered=False)
+        except PyMongoError as e:
+            logger.error('[%s] contract results could not be saved on MongoDB report: %s' % (len(results), e))
+
+    def update(self, summary):
+        try:
+            if not self.id:
+                self.id = self.collection.insert_one(dict(summary)).inserted_id
+            else:
+                self.collection.update_one({'_id': self.id}, {'$set': summary})
+        except PyMongoError as e:
+            logger.error('Report summary could not be saved on MongoDB: %s' % e)
+
+
+class NDJSONReportWriter(object):
+    """ Contract results are appended to a NDJSON file, one line per contract, and summary is written
+    to a JSON file next to it """
+    def __init__(self, path):
+        self.path = path
+        self.summary_path = '%s.summary.json' % os.path.splitext(path)[0]
+
+    def write(self, results):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(dumps(result, default=str) + '\n' for result in results))
+
+    def update(self, summary):
+        tmp = '%s.tmp' % self.summary_path
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(dumps(summary, default=str, indent=2))
+        os.replace(tmp, self.summary_path)
+
+
+class Report(object):
+    """ Execution report. Contract results received from workers are written in batches of flush_size and only
+    aggregated figures are kept in memory """
+    def __init__(self, writer, flush_size=None):
+        self.writer = writer
+        self.flush_size = flush_size or settings.REPORT_FLUSH_SIZE
         self.report = {
             'start': datetime.now(),
             'status': 'RUNNING',
-            'results': {}
+            'num_contracts': None,
+            'processed': 0,
+            'contracts_api': {},
+            'measures': {},
+            'errors': {},
+            'beedata_chunks': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0
         }
-        self.id = None
-        
-    def save(self):
-        if not self.id:
-            self.id = self.collection.insert_one(self.report)
-        else:
-            self.collection.find_one_and_update({'_id': self.id}, self.report, upsert=True)
-            
-        
+        self._pending = []
+        self.writer.update(self.report)
+
     def add_num_contracts(self, n):
         self.report['num_contracts'] = n
-        
+
     def add_results(self, cid, result):
-        self.report['results'][cid] = result
-        
+        """ Adds a contract result (returned by process_contract) to aggregates and to the pending batch """
+        report = self.report
+        report['processed'] += 1
+        contract_report = result.get('contract_report') or {}
+        call = '%s_%s' % (contract_report.get('contracts_api_call') or 'NONE', contract_report.get('contracts_api_status') or '')
+        report['contracts_api'][call] = report['contracts_api'].get(call, 0) + 1
+        for type_, measures in (result.get('measures_report') or {}).items():
+            report['measures'][type_] = report['measures'].get(type_, 0) + measures.get('measures', 0)
+            report['beedata_chunks'] += measures.get('beedata_chunks', 0)
+            if 'error' in measures or 'beedata_call_error' in measures:
+                report['errors'][type_] = report['errors'].get(type_, 0) + 1
+        if result.get('start') and result.get('finish'):
+            seconds = (result['finish'] - result['start']).total_seconds()
+            report['seconds'] += seconds
+            report['max_seconds'] = max(report['max_seconds'], seconds)
+
+        self._pending.append(dict(result, contractId=cid))
+        if len(self._pending) >= self.flush_size:
+            self.save()
+
+    def save(self):
+        """ Writes pending contract results and current summary """
+        if self._pending:
+            self.writer.write(self._pending)
+            self._pending = []
+        self.report['updated_at'] = datetime.now()
+        self.writer.update(self.report)
+
+    def interrupt(self):
+        """ Writes pending results when execution is stopped before finishing """
+        self.report['status'] = 'INTERRUPTED'
+        self.save()
+
     def finish(self):
         self.report['status'] = 'FINISHED'
         self.report['finish_at'] = datetime.now()
-        
-        self.save()
-    
-        
-    
 
+        self.save()
+        logger.info('Report: [%s] contracts processed in [%.1f] seconds (max [%.1f]). Contracts API calls: %s. Measures loaded: %s. Errors by type: %s'
+                    % (self.report['processed'], self.report['seconds'], self.report['max_seconds'], self.report['contracts_api'],
+                       self.report['measures'], self.report['errors']))
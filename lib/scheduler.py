@@ -0,0 +1,74 @@
+# encoding: utf-8
+
+# utils imports
+import logging
+
+# custom imports
+import settings
+from lib.utils import chunks, get_types, get_measures_dates, plan_cdc_windows
+
+logger = logging.getLogger("app")
+
+
+def estimate_cost(data, options, mongo_contract=None):
+    """ Estimates how many Enedis calls will be needed to process a contract: one per CDC 7 days window
+    plus one per PMAX or CONSOGLO range
+
+    :param data: contract document containing all information created on iter_contracts
+    :param options: dict with margindays, type and forceupdate
+    :param mongo_contract: document from MongoDB if it was stored
+    """
+    if 'error' in data:
+        return 0
+
+    cost = 0
+    for i in get_types(options['type']):
+        dates = get_measures_dates(data['auth'], data['document']['dateStart'], data['document']['dateEnd'], mongo_contract or {}, i, options['margindays'], options['forceupdate'])
+        if not dates:
+            continue
+        for direction in ['backward', 'forward']:
+            if dates[direction]:
+                cost += len(plan_cdc_windows(dates[direction], backward=direction == 'backward')) if i == 'CDC' else 1
+
+    return cost
+
+
+def iter_longest_first(contracts, options, window=None):
+    """ Reorders contracts so the most expensive ones are dispatched first. Contracts are read in windows of
+    settings.SCHEDULER_WINDOW to keep memory bounded. Expected cost is added to every contract data
+
+    :param contracts: iterator of (contractId, data) tuples
+    :param options: dict with margindays, type and forceupdate
+    :param window: number of contracts sorted together
+    """
+    for chunk in chunks(contracts, window or settings.SCHEDULER_WINDOW):
+        for id, data in chunk:
+            data['expected_cost'] = estimate_cost(data, options, data.get('state'))
+        chunk.sort(key=lambda item: item[1]['expected_cost'], reverse=True)
+        logger.debug('[%s] contracts scheduled. Expected Enedis calls: [%s]', len(chunk), sum(data['expected_cost'] for id, data in chunk))
+        for item in chunk:
+            yield item
+
+
+class CostModel(object):
+    """ Converts expected cost into expected wall time learning seconds per Enedis call from finished contracts """
+    def __init__(self, seconds_per_call=None, alpha=0.1):
+        self.seconds_per_call = seconds_per_call or settings.SCHEDULER_SECONDS_PER_CALL
+        self.alpha = alpha
+
+    def predict(self, cost):
+        return cost * self.seconds_per_call
+
+    def update(self, id, cost, result):
+        """ Logs predicted vs actual wall time for a finished contract and adjusts seconds per call
+
+        :param id: contractId
+        :param cost: expected cost of the contract
+        :param result: report returned by process_contract
+        """
+        if not result or cost is None:
+            return
+        actual = (result['finish'] - result['start']).total_seconds()
+        logger.info('Contract [%s] processed in [%.1f] seconds. Predicted: [%.1f] seconds for [%s] Enedis calls' % (id, actual, self.predict(cost), cost))
+        if cost:
+            self.seconds_per_call = (1 - self.alpha) * self.seconds_per_call + self.alpha * actual / cost
@@ -0,0 +1,240 @@
+# encoding: utf-8
+
+# utils imports
+import time
+import logging
+import sqlite3
+from itertools import islice
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# custom imports
+import settings
+from lib.metrics import metrics
+from lib.transformations import date_converter
+from lib.security import encode
+
+logger = logging.getLogger("app")
+
+MEASURE_TYPES = ['PMAX', 'CONSOGLO', 'CDC']
+
+# fields needed to resume a contract. prm is never loaded back
+STATE_FIELDS = ['contractId', 'etag', 'remote_etag'] + ['ts_%s_%s' % (edge, i) for i in MEASURE_TYPES for edge in ['min', 'max']]
+
+# every field saved by state_document
+DOCUMENT_FIELDS = STATE_FIELDS + ['prm', 'meteringPointId', 'last_op']
+
+
+def state_document(id, ts_min, ts_max, etag, prm, remote_etag=None):
+    """ Builds the checkpoint saved once a contract has been processed. Stored etags are kept if they are None
+
+    :param id: contractId
+    :param ts_min: dict containing first recovered measure by type
+    :param ts_max: dict containing last recovered measure by type
+    :param etag: contract document etag of last CSV uploaded to Beedata
+    :param prm: contract prm
+    :param remote_etag: contract _etag on Beedata API after last POST or PATCH
+    """
+    doc = {
+        'contractId': id,
+        'prm': prm,
+        'meteringPointId': encode(prm),
+        'last_op': datetime.now()
+    }
+    if etag:
+        doc['etag'] = etag
+    if remote_etag:
+        doc['remote_etag'] = remote_etag
+    for i in MEASURE_TYPES:
+        if i in ts_min and ts_min[i]:
+            doc['ts_min_%s' % i] = ts_min[i]
+        if i in ts_max and ts_max[i]:
+            doc['ts_max_%s' % i] = ts_max[i]
+
+    return doc
+
+
+def parse_state(doc):
+    """ Converts ts_ fields stored as strings into datetime """
+    for field, value in doc.items():
+        if 'ts_' in field and value and isinstance(value, str):
+            doc[field] = date_converter(value, format=settings.DATETIME_FORMAT)
+
+    return doc
+
+
+class StateStore(object):
+    """ Base class for contracts state (etag, ts_min and ts_max by measure type) backends. States are loaded in bulk
+    and checkpoints are buffered and written together every flush_size contracts or flush_interval seconds.
+    Subclasses implement load and write """
+    def __init__(self, flush_size=None, flush_interval=None):
+        self.flush_size = flush_size or settings.STATE_FLUSH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else settings.STATE_FLUSH_INTERVAL
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def load(self, contract_ids=None):
+        """ Returns stored states by contractId, every stored state if contract_ids is None
+
+        :param contract_ids: list of contractId or None
+        """
+        raise NotImplementedError
+
+    def write(self, docs):
+        """ Saves a batch of documents built by state_document. Existing fields not present on a document are kept
+
+        :param docs: list of documents
+        """
+        raise NotImplementedError
+
+    def save(self, id, ts_min, ts_max, etag, prm, remote_etag=None):
+        """ Buffers contract checkpoint. Buffer is written every flush_size contracts or flush_interval seconds """
+        self._pending[id] = state_document(id, ts_min, ts_max, etag, prm, remote_etag)
+        if len(self._pending) >= self.flush_size or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes buffered checkpoints """
+        self._last_flush = time.time()
+        if not self._pending:
+            return
+        docs = list(self._pending.values())
+        self._pending = {}
+        with metrics.timer('state_write_seconds', backend=self.__class__.__name__):
+            self.write(docs)
+
+    def close(self):
+        self.flush()
+
+
+class MongoStateStore(StateStore):
+    """ State stored on MongoDB Contracts collection, written with unordered bulk upserts """
+    def __init__(self, mongo_db, flush_size=None, flush_interval=None):
+        super(MongoStateStore, self).__init__(flush_size, flush_interval)
+        self.collection = mongo_db['Contracts']
+
+    def load(self, contract_ids=None):
+        """ Every document of the collection is read with a single projected cursor if contract_ids is None,
+        otherwise a single $in query is done """
+        query = {} if contract_ids is None else {'contractId': {'$in': list(contract_ids)}}
+        projection = dict([(field, 1) for field in STATE_FIELDS], _id=0)
+        states = {}
+        for doc in self.collection.find(query, projection):
+            states[doc['contractId']] = parse_state(doc)
+        logger.debug('[%s] contract states recovered from MongoDB', len(states))
+
+        return states
+
+    def write(self, docs):
+        operations = [UpdateOne({'contractId': doc['contractId']}, {'$set': doc}, upsert=True) for doc in docs]
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            logger.debug('[%s] contract states saved on MongoDB (upserted: %s, modified: %s)', len(operations), result.upserted_count, result.modified_count)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            logger.error('[%s] of [%s] contract states could not be saved on MongoDB: %s' % (len(errors), len(operations), errors[:5]))
+        except PyMongoError as e:
+            logger.error('Contract states could not be saved on MongoDB: %s' % e)
+
+
+class SQLiteStateStore(StateStore):
+    """ State stored on a local SQLite file in WAL mode, so no server is needed. Every process opens its own
+    connection: readers never block and writers wait up to settings.STATE_SQLITE_TIMEOUT seconds for the lock.
+    Each flush is committed as a single transaction. With a pool the parent store is read from the pool task handler
+    thread, so the connection is not bound to the thread that created it (it is never used by two threads at once) """
+    # SQLite default max number of host parameters on old versions is 999
+    MAX_VARIABLES = 500
+
+    def __init__(self, path=None, flush_size=None, flush_interval=None):
+        super(SQLiteStateStore, self).__init__(flush_size, flush_interval)
+        self.path = path or settings.STATE_SQLITE_PATH
+        self.connection = sqlite3.connect(self.path, timeout=settings.STATE_SQLITE_TIMEOUT, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS contracts (%s, PRIMARY KEY (contractId))' % ', '.join('%s TEXT' % field for field in DOCUMENT_FIELDS))
+            # files created by previous versions
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(contracts)')]
+            for field in DOCUMENT_FIELDS:
+                if field not in columns:
+                    self.connection.execute('ALTER TABLE contracts ADD COLUMN %s TEXT' % field)
+        logger.debug('Contracts state stored on SQLite file [%s]', self.path)
+
+    def load(self, contract_ids=None):
+        query = 'SELECT %s FROM contracts' % ', '.join(STATE_FIELDS)
+        if contract_ids is None:
+            rows = self.connection.execute(query).fetchall()
+        else:
+            contract_ids = list(contract_ids)
+            rows = []
+            for i in range(0, len(contract_ids), self.MAX_VARIABLES):
+                batch = contract_ids[i:i + self.MAX_VARIABLES]
+                rows.extend(self.connection.execute('%s WHERE contractId IN (%s)' % (query, ', '.join('?' * len(batch))), batch).fetchall())
+        states = {}
+        for row in rows:
+            states[row[0]] = parse_state(dict((field, value) for field, value in zip(STATE_FIELDS, row) if value is not None))
+        logger.debug('[%s] contract states recovered from SQLite', len(states))
+
+        return states
+
+    def write(self, docs):
+        fields = ', '.join(DOCUMENT_FIELDS)
+        updates = ', '.join('%s = COALESCE(excluded.%s, %s)' % (field, field, field) for field in DOCUMENT_FIELDS[1:])
+        query = 'INSERT INTO contracts (%s) VALUES (%s) ON CONFLICT (contractId) DO UPDATE SET %s' % (fields, ', '.join('?' * len(DOCUMENT_FIELDS)), updates)
+        rows = []
+        for doc in docs:
+            rows.append([value.strftime(settings.DATETIME_FORMAT) if isinstance(value, datetime) else value for value in (doc.get(field) for field in DOCUMENT_FIELDS)])
+        try:
+            with self.connection:
+                self.connection.executemany(query, rows)
+            logger.debug('[%s] contract states saved on SQLite', len(rows))
+        except sqlite3.Error as e:
+            logger.error('[%s] contract states could not be saved on SQLite: %s' % (len(rows), e))
+
+    def close(self):
+        super(SQLiteStateStore, self).close()
+        self.connection.close()
+
+
+def get_state_store(backend, mongo_db=None):
+    """ Creates the state store for the backend selected with --state argument
+
+    :param backend: one of NONE, MONGO or SQLITE
+    :param mongo_db: MongoDB connector, needed for MONGO backend
+    """
+    if backend == 'MONGO':
+        return MongoStateStore(mongo_db)
+    elif backend == 'SQLITE':
+        return SQLiteStateStore()
+
+    return None
+
+
+def iter_with_state(contracts, store, batch_size=None):
+    """ Wraps contracts iterator adding stored state of every contract on its state field.
+    If batch_size is 0 every state is preloaded at once, otherwise they are recovered by batches of contracts
+
+    :param contracts: iterator of (contractId, data) tuples as yielded by iter_contracts
+    :param store: state store
+    :param batch_size: number of contracts whose state is recovered together
+    """
+    batch_size = settings.STATE_LOAD_BATCH if batch_size is None else batch_size
+    if not batch_size:
+        with metrics.timer('state_load_seconds', backend=store.__class__.__name__):
+            states = store.load()
+        for id, data in contracts:
+            data['state'] = states.get(id)
+            yield id, data
+        return
+
+    contracts = iter(contracts)
+    while True:
+        chunk = list(islice(contracts, batch_size))
+        if not chunk:
+            return
+        with metrics.timer('state_load_seconds', backend=store.__class__.__name__):
+            states = store.load([id for id, data in chunk])
+        for id, data in chunk:
+            data['state'] = states.get(id)
+            yield id, data
@@ -1,27 +1,67 @@
 # encoding: utf-8
 
 import csv
+import asyncio
 import logging
 import hashlib
 from pymongo import MongoClient
 from datetime import datetime, timedelta, date
+from queue import Queue
 from json import dumps
 from copy import deepcopy
+from collections import deque
+from itertools import islice
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 # custom imports
 import settings 
 from lib.transformations import date_converter, str2bool
-#from lib.security import encode
-#from lib.enedis_connector import get_data, init_webservice_client
+from lib.log import log_payload
+from lib.metrics import metrics
+from lib.profiler import profiled
+from lib.measures import iter_measures_chunks, format_timestamp
+from lib.enedis_connector import get_data, async_get_data, get_cached_data, init_async_webservice_client, LazyWebserviceClient
+from lib.cache import get_cache
+from lib.journal import get_journal, unit_key, CONTRACT_UNIT
 from lib.beedata_connector import BaseClient
+from lib.state import get_state_store
 
 
-# init clients to reuse them through all services calls
-#ws_client = init_webservice_client()
-beedata_client = BaseClient()
+# clients reused through all services calls of current process, created by init_clients
+ws_client = None
+beedata_client = None
+mongo_db = None
+state_store = None
+# CDC windows are recovered with asyncio Enedis client instead of threads
+enedis_async = False
 logger = logging.getLogger("app")
 
 
+def init_clients(enedis=True, state='NONE', use_async=False):
+    """ Creates the clients used by process_contract on current process
+    
+    :param enedis: create Enedis webservice client (not needed if no measures are recovered)
+    :param state: contracts state backend. MongoDB is only connected if it is MONGO
+    :param use_async: recover CDC windows with asyncio Enedis client (see fetch_windows_async)
+    """
+    global ws_client, beedata_client, mongo_db, state_store, enedis_async
+    beedata_client = BaseClient()
+    enedis_async = use_async
+    if enedis:
+        # WSDL is only loaded when the first request is sent
+        ws_client = LazyWebserviceClient()
+    if state == 'MONGO':
+        mongo_db = connect_mongo()
+    state_store = get_state_store(state, mongo_db)
+
+
+def close_clients():
+    """ Writes pending contracts state of current process """
+    if state_store:
+        state_store.close()
+
+
 def connect_mongo():
     """ Return a connector to DataBase defined at settings """
     logger.debug('Connecting to MongoDB...')
@@ -37,20 +77,70 @@ def connect_mongo():
     return db
     
 
-def read_csv_file(path, delimiter=','):
-    """ Parse CSV and returns a list of row dicts
+def iter_csv_file(path, delimiter=','):
+    """ Parse CSV and yields its rows as dicts one by one
     
     :param path: Path where file is
     :param delimiter: Delimiter for CSV file. Default ';'
     """
-    #with open(path, mode='r', encoding='utf-8') as csv_file:
     with open(path, mode='r') as csv_file:
         csv_reader = csv.DictReader(csv_file, delimiter=delimiter)
-        rows = []
         for row in csv_reader:
-            rows.append(row)
-        
-        return rows
+            yield row
+
+
+def index_rows(rows, column, name):
+    """ Index CSV rows by one of its columns to avoid linear searches when merging files.
+    If a value is repeated, first row found is kept (same behavior than searching row by row on the full list)
+    
+    :param rows: iterable of CSV row dicts
+    :param column: column name used as index key
+    :param name: file name used on logs
+    """
+    index = {}
+    duplicates = []
+    for row in rows:
+        key = row[column]
+        if key in index:
+            duplicates.append(key)
+        else:
+            index[key] = row
+    
+    if duplicates:
+        logger.warning('[%s] rows on %s file ignored because PDL was already defined on a previous row: [%s]' % (len(duplicates), name, duplicates))
+    logger.debug('Rows indexed for %s file: [%s]', name, len(index))
+    
+    return index
+
+
+def index_repeated_rows(path, delimiter, column):
+    """ Reads only one column of a CSV file and returns the number of the last row of every repeated value,
+    so repeated rows can be skipped while the file is streamed (last row wins, like building a dict with every row)
+    
+    :param path: CSV file path
+    :param delimiter: CSV delimiter
+    :param column: column name to check
+    
+    :return dict of value: last row number (0 based, same numbering than csv.DictReader rows)
+    """
+    seen = set()
+    repeated = {}
+    with open(path, mode='r') as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=delimiter)
+        position = next(csv_reader).index(column)
+        number = 0
+        for row in csv_reader:
+            if not row:
+                # DictReader skips empty rows
+                continue
+            key = row[position] if position < len(row) else None
+            if key in seen:
+                repeated[key] = number
+            else:
+                seen.add(key)
+            number += 1
+    
+    return repeated
 
 
 def get_modification(row, number):
@@ -86,22 +176,32 @@ def get_modification_dict(row, number, modification):
     return result
 
 
-def get_contracts(paths):
-    """ Creates a dictionary containing all contract information from the 3 required CSV
+def iter_contracts(paths):
+    """ Yields (contractId, contract information) tuples merging the 3 required CSV.
+    Contracts CSV is streamed row by row, only authorizations and hours indexes are kept in memory
     
     :param paths: paths from argparse (it might have all required arguments)
     """
-    logger.debug('Start reading CSV files to merge in a common structure...')
-    contracts = read_csv_file(paths.contracts, delimiter=settings.CONTRACTS_DELIMITER)
-    authorizations = read_csv_file(paths.authorizations, delimiter=settings.AUTHORIZATIONS_DELIMITER)
-    hours = read_csv_file(paths.hours, delimiter=settings.HOURS_DELIMITER)
-    logger.debug('Files read successfully. Creating contracts documents and adding needed information...')
+    logger.debug('Start reading authorizations and hours CSV files to index them by PDL...')
+    with metrics.timer('csv_index_seconds', file='authorizations'):
+        auth_index = index_rows(iter_csv_file(paths.authorizations, delimiter=settings.AUTHORIZATIONS_DELIMITER), settings.AUTHORIZATIONS_COLUMNS['meteringPointId'], 'authorizations')
+    with metrics.timer('csv_index_seconds', file='hours'):
+        hours_index = index_rows(iter_csv_file(paths.hours, delimiter=settings.HOURS_DELIMITER), settings.HOURS_COLUMNS['meteringPointId'], 'hours')
+    logger.debug('Files indexed successfully. Creating contracts documents and adding needed information...')
     
     logger.debug('Start creating contracts documents...')
-    contracts_data = {}
+    # a contract on several rows is processed once, with its last row
+    repeated = index_repeated_rows(paths.contracts, settings.CONTRACTS_DELIMITER, settings.CONTRACT_COLUMNS['contractId'])
+    if repeated:
+        logger.warning('[%s] contracts are repeated on contracts file, only their last row is processed: [%s]' % (len(repeated), list(repeated)))
+    contracts = iter_csv_file(paths.contracts, delimiter=settings.CONTRACTS_DELIMITER)
+    num_contracts = 0
     hours_errors = []
     auth_errors = []
-    for contract in contracts:
+    join_stats = {'auth_hits': 0, 'auth_misses': 0, 'hours_hits': 0, 'hours_misses': 0}
+    for number, contract in enumerate(contracts):
+        if repeated.get(contract[settings.CONTRACT_COLUMNS['contractId']], number) != number:
+            continue
         # creating document for beedata
         # date end that will be used for history creation
         date_end = datetime(2099, 1, 1).strftime(settings.DATETIME_FORMAT)
@@ -111,7 +211,7 @@ def get_contracts(paths):
             except ValueError:
                 raise Exception('Contract row for contract [%s] has end date in bad format: [%s]' % (contract[settings.CONTRACT_COLUMNS['contractId']], contract[settings.CONTRACT_COLUMNS['dateEnd']]))
             
-        contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]] = {
+        contract_data = {
             'document': {
                 'contractId': contract[settings.CONTRACT_COLUMNS['contractId']],
                 'customer': {
@@ -139,7 +239,7 @@ def get_contracts(paths):
             },
             'contract_type': 'residential' if contract[settings.CONTRACT_COLUMNS['contract_type']].lower() == 'particulier' else 'tertiary'
         }
-        contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['csv'] = contract
+        contract_data['csv'] = contract
         
         # create history fields
         tariff_history = []
@@ -162,16 +262,16 @@ def get_contracts(paths):
                 'tariffId': contract[settings.CONTRACT_COLUMNS['tariffId']]
             })
             # get last (current) tariff for tariff_ field
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_'] = tariff_history[-1]
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffHistory'] = tariff_history
+            contract_data['document']['tariff_'] = tariff_history[-1]
+            contract_data['document']['tariffHistory'] = tariff_history
         else:
             # no history, just set tariff_ to current and use it as unique tariffHistory item
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_'] = {
-                'dateStart': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['dateStart'],
-                'dateEnd': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['dateEnd'],
-                'tariffId': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']
+            contract_data['document']['tariff_'] = {
+                'dateStart': contract_data['document']['dateStart'],
+                'dateEnd': contract_data['document']['dateEnd'],
+                'tariffId': contract_data['document']['tariffId']
             }
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffHistory'] = [contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_']]
+            contract_data['document']['tariffHistory'] = [contract_data['document']['tariff_']]
         
         if power_history:
             # add current power with last dateEnd as dateStart
@@ -181,132 +281,158 @@ def get_contracts(paths):
                 'power': int(float(contract[settings.CONTRACT_COLUMNS['power']])*1000)
             })
             # get last (current) power for power_ field
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['power_'] = power_history[-1]
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['powerHistory'] = power_history
+            contract_data['document']['power_'] = power_history[-1]
+            contract_data['document']['powerHistory'] = power_history
         else:
             # no history, just set power_ to current and use it as unique powerHistory item
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['power_'] = {
-                'dateStart': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['dateStart'],
-                'dateEnd': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['dateEnd'],
-                'power': contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['power']
+            contract_data['document']['power_'] = {
+                'dateStart': contract_data['document']['dateStart'],
+                'dateEnd': contract_data['document']['dateEnd'],
+                'power': contract_data['document']['power']
             }
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['powerHistory'] = [contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['power_']]
+            contract_data['document']['powerHistory'] = [contract_data['document']['power_']]
         logger.debug('Created contracts documents successfully.')
 
         logger.debug('Adding authorization information...')
-        for authorization in authorizations:
-            # search on full authorization list
-            if authorization[settings.AUTHORIZATIONS_COLUMNS['meteringPointId']] == contract[settings.CONTRACT_COLUMNS['meteringPointId']]:
-                try:
-                    auth_dict = {
-                        'auth30': str2bool(authorization[settings.AUTHORIZATIONS_COLUMNS['auth30']]),
-                        'dateStart30': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateStart30']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateStart30']] else None,
-                        'dateEnd30': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateEnd30']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateEnd30']] else None,
-                        'authDay': str2bool(authorization[settings.AUTHORIZATIONS_COLUMNS['authDay']]),
-                        'dateStartDay': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateStartDay']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateStartDay']] else None,
-                        'dateEndDay': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateEndDay']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateEndDay']] else None
-                    }
-                except ValueError:
-                    raise Exception('Authorization row is not well formed due to dates or bad values: [%s]' % authorization)
-
-                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['auth'] = auth_dict
-                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['customFields']['auth'] = {
-                    'auth30': auth_dict['auth30'],
-                    'dateStart30': auth_dict['dateStart30'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateStart30'] else '',
-                    'dateEnd30': auth_dict['dateEnd30'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateEnd30'] else '',
-                    'authDay': auth_dict['authDay'],
-                    'dateStartDay': auth_dict['dateStartDay'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateStartDay'] else '',
-                    'dateEndDay': auth_dict['dateEndDay'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateEndDay'] else '',
+        authorization = auth_index.get(contract[settings.CONTRACT_COLUMNS['meteringPointId']])
+        if authorization is not None:
+            join_stats['auth_hits'] += 1
+            try:
+                auth_dict = {
+                    'auth30': str2bool(authorization[settings.AUTHORIZATIONS_COLUMNS['auth30']]),
+                    'dateStart30': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateStart30']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateStart30']] else None,
+                    'dateEnd30': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateEnd30']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateEnd30']] else None,
+                    'authDay': str2bool(authorization[settings.AUTHORIZATIONS_COLUMNS['authDay']]),
+                    'dateStartDay': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateStartDay']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateStartDay']] else None,
+                    'dateEndDay': date_converter(authorization[settings.AUTHORIZATIONS_COLUMNS['dateEndDay']], format=settings.AUTHORIZATIONS_DATETIME_FORMAT) if authorization[settings.AUTHORIZATIONS_COLUMNS['dateEndDay']] else None
                 }
-                break
+            except ValueError:
+                raise Exception('Authorization row is not well formed due to dates or bad values: [%s]' % authorization)
+
+            contract_data['auth'] = auth_dict
+            contract_data['document']['customFields']['auth'] = {
+                'auth30': auth_dict['auth30'],
+                'dateStart30': auth_dict['dateStart30'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateStart30'] else '',
+                'dateEnd30': auth_dict['dateEnd30'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateEnd30'] else '',
+                'authDay': auth_dict['authDay'],
+                'dateStartDay': auth_dict['dateStartDay'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateStartDay'] else '',
+                'dateEndDay': auth_dict['dateEndDay'].strftime(settings.DATETIME_FORMAT) if auth_dict['dateEndDay'] else '',
+            }
             
-        if 'auth' not in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]:
+        if 'auth' not in contract_data:
             # check if auth info is available, if not add to error list
-            auth_errors.append(contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['contractId'])
-            contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['error'] = {'auth': True}
+            join_stats['auth_misses'] += 1
+            auth_errors.append(contract_data['document']['contractId'])
+            contract_data['error'] = {'auth': True}
         
         logger.debug('Authorization information successfully added.')
         
         logger.debug('Adding discrimination hours information...')
-        for hour in hours:
-            # search on full hours list
-            if hour[settings.HOURS_COLUMNS['meteringPointId']] == contract[settings.CONTRACT_COLUMNS['meteringPointId']]:
-                date_end = date_converter(contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['dateEnd'], format=settings.DATETIME_FORMAT)
-                
-                try:
-                    mod_date = date_converter(hour[settings.HOURS_COLUMNS['modification']], format=settings.HOURS_DATETIME_FORMAT)
-                except ValueError:
-                    raise Exception('Hour row end date [%s] is not well formed: [%s]' % (hour[settings.HOURS_COLUMNS['modification']], hour))
-
-                if hour[settings.HOURS_COLUMNS['modification']] and date_end > mod_date:
-                    if hour[settings.HOURS_COLUMNS['currentHours']]:
-                        # add discrimination schedule on tariffHistory, tariffId, and tariff_ fields
-                        for t in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffHistory']:
-                            if t['tariffId'] == contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                if 'SDT' not in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                    if 'CDD ' in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                        t['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
-                                    else:
-                                        t['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
+        hour = hours_index.get(contract[settings.CONTRACT_COLUMNS['meteringPointId']])
+        if hour is not None:
+            join_stats['hours_hits'] += 1
+            date_end = date_converter(contract_data['document']['dateEnd'], format=settings.DATETIME_FORMAT)
+            
+            try:
+                mod_date = date_converter(hour[settings.HOURS_COLUMNS['modification']], format=settings.HOURS_DATETIME_FORMAT)
+            except ValueError:
+                raise Exception('Hour row end date [%s] is not well formed: [%s]' % (hour[settings.HOURS_COLUMNS['modification']], hour))
+
+            if hour[settings.HOURS_COLUMNS['modification']] and date_end > mod_date:
+                if hour[settings.HOURS_COLUMNS['currentHours']]:
+                    # add discrimination schedule on tariffHistory, tariffId, and tariff_ fields
+                    for t in contract_data['document']['tariffHistory']:
+                        if t['tariffId'] == contract_data['document']['tariffId']:
+                            if 'SDT' not in contract_data['document']['tariffId']:
+                                if 'CDD ' in contract_data['document']['tariffId']:
+                                    t['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
                                 else:
-                                    if 'CDD ' in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                        t['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )'
-                                    else:
-                                        t['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']
-                        if 'SDT' not in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                            if 'CDD ' in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
+                                    t['tariffId'] = contract_data['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
                             else:
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]    
+                                if 'CDD ' in contract_data['document']['tariffId']:
+                                    t['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )'
+                                else:
+                                    t['tariffId'] = contract_data['document']['tariffId']
+                    if 'SDT' not in contract_data['document']['tariffId']:
+                        if 'CDD ' in contract_data['document']['tariffId']:
+                            contract_data['document']['tariff_']['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
+                            contract_data['document']['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )' + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
                         else:
-                            if 'CDD ' in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']:
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )'
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] + ' ( Pro. )'
-                            else:
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariff_']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']
-                                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId'] = contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['tariffId']
-                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['customFields']['hours'] = hour[settings.HOURS_COLUMNS['currentHours']]
-                break
+                            contract_data['document']['tariff_']['tariffId'] = contract_data['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]
+                            contract_data['document']['tariffId'] = contract_data['document']['tariffId'] + '~' + hour[settings.HOURS_COLUMNS['currentHours']]    
+                    else:
+                        if 'CDD ' in contract_data['document']['tariffId']:
+                            contract_data['document']['tariff_']['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )'
+                            contract_data['document']['tariffId'] = contract_data['document']['tariffId'] + ' ( Pro. )'
+                        else:
+                            contract_data['document']['tariff_']['tariffId'] = contract_data['document']['tariffId']
+                            contract_data['document']['tariffId'] = contract_data['document']['tariffId']
+            contract_data['document']['customFields']['hours'] = hour[settings.HOURS_COLUMNS['currentHours']]
                 
-        if 'hours' not in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['customFields']:
+        if 'hours' not in contract_data['document']['customFields']:
             # check if hours info is available, if not add to error list
-            hours_errors.append(contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['document']['contractId'])
-            if 'error' in contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]:
-                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['error']['hours'] = True
+            join_stats['hours_misses'] += 1
+            hours_errors.append(contract_data['document']['contractId'])
+            if 'error' in contract_data:
+                contract_data['error']['hours'] = True
             else: 
-                contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]['error'] = {'hours': True}
+                contract_data['error'] = {'hours': True}
         
         logger.debug('Discrimination hours information successfully added.')
         
-        logger.debug('Final document: %s' % (contracts_data[contract[settings.CONTRACT_COLUMNS['contractId']]]))
+        log_payload(logger, 'Final document: %s', contract_data)
+        num_contracts += 1
+        metrics.inc('contracts_read_total', outcome='error' if 'error' in contract_data else 'ok')
+        yield contract[settings.CONTRACT_COLUMNS['contractId']], contract_data
         
+    logger.info('Authorizations join: [%s] hits, [%s] misses' % (join_stats['auth_hits'], join_stats['auth_misses']))
+    logger.info('Hours join: [%s] hits, [%s] misses' % (join_stats['hours_hits'], join_stats['hours_misses']))
     if auth_errors:
         logger.error('Authorization information not available for this contracts and won\'t be processed: [%s]' % auth_errors)
     if hours_errors:
         logger.error('Hours information not available for this contracts and won\'t be processed: [%s]' % hours_errors)
 
     logger.info('Contracts documents and required information successfully created.')
-    logger.info('Contracts read: [%s]' % len(contracts_data.keys()))
-    
-    return contracts_data
+    logger.info('Contracts read: [%s]' % num_contracts)
+
+
+def response_etag(response):
+    """ Returns _etag of the document created or modified on Beedata API from its response or None """
+    try:
+        return response.json().get('_etag')
+    except (ValueError, AttributeError):
+        return None
+
+
+def patch_contract(beedata_client, document, remote_etag=None):
+    """ PATCHes a contract with the remote etag already known. If it is outdated (412) the etag is recovered again
     
+    :param beedata_client: connector to Beedata API
+    :param document: contract document
+    :param remote_etag: _etag of the contract on Beedata API if it is known
+    """
+    res = beedata_client.modify_contract(document, remote_etag)
+    if remote_etag and res.status_code == 412:
+        logger.debug('Stored etag of contract [%s] is outdated. Recovering it from Beedata API', document['contractId'])
+        res = beedata_client.modify_contract(document)
     
+    return res
+
+
 def upload_contract(mongo_contract, data, current_etag, beedata_client):
     """ Function to decide when contract needs to be POST, PATCH or nothing
      
-    :param mongo_contract: document from MongoDB if it was stored
+    :param mongo_contract: stored state of the contract if it was stored
     :param data: contract document with all needed information
     :param current_etag: string to determine if a contract has modifications since last operation
     :param beedata_client: connector to Beedata API
     """
     contract_report = {}
     if not mongo_contract or (mongo_contract and 'etag' not in mongo_contract):
-    	aux_ = beedata_client.get_contract(data['document']['contractId'])
+        aux_ = beedata_client.get_contract(data['document']['contractId'])
         _etag = aux_.get('_etag',None) if aux_ else None
         if _etag:
-            logger.debug('Contract [%s] already on Beedata API... Proceeding with a PATCH operation' % data['document']['contractId'])
+            logger.debug('Contract [%s] already on Beedata API... Proceeding with a PATCH operation', data['document']['contractId'])
             res = beedata_client.modify_contract(data['document'], _etag)
             contract_report['contracts_api_call'] = 'PATCH'
             contract_report['contracts_api_status'] = res.status_code
@@ -314,9 +440,10 @@ def upload_contract(mongo_contract, data, current_etag, beedata_client):
                 contract_report['contracts_api_error'] = res.text
                 logger.error('Beedata API response was unexpected on PATCH existing contract [%s]:    %s' % (data['document']['contractId'], res.text))
             else:
-                logger.debug('PATCH contract [%s] successfully modified on Beedata API.' % (data['document']['contractId']))
+                contract_report['remote_etag'] = response_etag(res)
+                logger.debug('PATCH contract [%s] successfully modified on Beedata API.', data['document']['contractId'])
         else:
-            logger.debug('POST new contract [%s] to Beedata' % (data['document']['contractId']))
+            logger.debug('POST new contract [%s] to Beedata', data['document']['contractId'])
             res = beedata_client.send_data(data['document'], 'contracts')
             contract_report['contracts_api_call'] = 'POST'
             contract_report['contracts_api_status'] = res.status_code
@@ -324,19 +451,21 @@ def upload_contract(mongo_contract, data, current_etag, beedata_client):
                 contract_report['contracts_api_error'] = res.text
                 logger.error('Beedata API response was unexpected on POST new contract [%s]:    %s' % (data['document']['contractId'], res.text))
             else:
+                contract_report['remote_etag'] = response_etag(res)
                 logger.info('New contract [%s] successfully created on Beedata API.' % (data['document']['contractId']))
             
     else:
         if mongo_contract['etag'] != current_etag:
-            logger.debug('PATCH contract [%s] to Beedata' % (data['document']['contractId']))
-            res = beedata_client.modify_contract(data['document'])
+            logger.debug('PATCH contract [%s] to Beedata', data['document']['contractId'])
+            res = patch_contract(beedata_client, data['document'], mongo_contract.get('remote_etag'))
             contract_report['contracts_api_call'] = 'PATCH'
             contract_report['contracts_api_status'] = res.status_code
             if res.status_code != 200:
                 contract_report['contracts_api_error'] = res.text
                 logger.error('Beedata API response was unexpected on PATCH existing contract [%s]:    %s' % (data['document']['contractId'], res.text))
             else:
-                logger.debug('PATCH contract [%s] successfully modified on Beedata API.' % (data['document']['contractId']))
+                contract_report['remote_etag'] = response_etag(res)
+                logger.debug('PATCH contract [%s] successfully modified on Beedata API.', data['document']['contractId'])
         else:
             contract_report['contracts_api_call'] = None
             contract_report['contracts_api_status'] = None
@@ -345,6 +474,132 @@ def upload_contract(mongo_contract, data, current_etag, beedata_client):
     return contract_report
 
 
+def contract_synced(contract_report):
+    """ True if contract is on Beedata API as it is on the CSV after upload_contract or sync_contracts """
+    return contract_report.get('contracts_api_status') in (None, 200, 201)
+
+
+def chunks(iterable, size):
+    """ Yields lists of size elements (last one may be smaller) from any iterable
+    
+    :param iterable: iterable to split
+    :param size: number of elements per chunk
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sync_contracts(contracts, beedata_client, verify_remote=False):
+    """ Bulk version of upload_contract. Decides for a chunk of contracts which ones need to be POSTed, PATCHed or nothing
+    recovering remote etags and creating new contracts with as few requests as possible.
+    
+    :param contracts: list of (contractId, data) tuples as yielded by iter_contracts
+    :param beedata_client: connector to Beedata API
+    :param verify_remote: check that unmodified contracts are still on Beedata API with the stored etag
+    
+    :return dict with contract_report for every contract processed by contractId
+    """
+    reports = {}
+    pending = {}
+    unmodified = {}
+    for id, data in contracts:
+        if 'error' in data:
+            continue
+        mongo_contract = data.get('state')
+        if mongo_contract and 'etag' in mongo_contract and mongo_contract['etag'] == document_etag(data['document']):
+            if verify_remote:
+                unmodified[id] = mongo_contract.get('remote_etag')
+                pending[id] = data
+                continue
+            reports[id] = {
+                'contracts_api_call': None,
+                'contracts_api_status': None
+            }
+            logger.info('Contract [%s] does not have modifications. No calls to Beedata API needed.' % id)
+        else:
+            pending[id] = data
+    
+    if not pending:
+        return reports
+    
+    logger.debug('Recovering etags for [%s] contracts from Beedata API...', len(pending))
+    remote_etags = beedata_client.get_contracts_etags(list(pending.keys()))
+    if remote_etags is None:
+        logger.warning('Beedata API response was unexpected recovering contracts etags. Uploading contracts one by one.')
+        for id, data in pending.items():
+            reports[id] = upload_contract(data.get('state'), data, document_etag(data['document']), beedata_client)
+        return reports
+    
+    for id, remote_etag in unmodified.items():
+        if remote_etags.get(id) and remote_etags[id] == remote_etag:
+            del pending[id]
+            reports[id] = {
+                'contracts_api_call': None,
+                'contracts_api_status': None
+            }
+            logger.info('Contract [%s] does not have modifications and it is up to date on Beedata API.' % id)
+        else:
+            logger.warning('Contract [%s] on Beedata API does not match stored etag. Uploading it again.' % id)
+    
+    new_contracts = []
+    for id, data in pending.items():
+        if id in remote_etags:
+            logger.debug('Contract [%s] already on Beedata API... Proceeding with a PATCH operation', id)
+            res = beedata_client.modify_contract(data['document'], remote_etags[id])
+            reports[id] = {
+                'contracts_api_call': 'PATCH',
+                'contracts_api_status': res.status_code
+            }
+            if res.status_code != 200:
+                reports[id]['contracts_api_error'] = res.text
+                logger.error('Beedata API response was unexpected on PATCH existing contract [%s]:    %s' % (id, res.text))
+            else:
+                reports[id]['remote_etag'] = response_etag(res)
+                logger.debug('PATCH contract [%s] successfully modified on Beedata API.', id)
+        else:
+            new_contracts.append(data['document'])
+    
+    if new_contracts:
+        logger.debug('POST [%s] new contracts to Beedata', len(new_contracts))
+        results = beedata_client.send_bulk(new_contracts, 'contracts')
+        for document, (status, error, remote_etag) in zip(new_contracts, results):
+            reports[document['contractId']] = {
+                'contracts_api_call': 'POST',
+                'contracts_api_status': status
+            }
+            if status != 201:
+                reports[document['contractId']]['contracts_api_error'] = error
+                logger.error('Beedata API response was unexpected on POST new contract [%s]:    %s' % (document['contractId'], error))
+            else:
+                reports[document['contractId']]['remote_etag'] = remote_etag
+                logger.info('New contract [%s] successfully created on Beedata API.' % document['contractId'])
+    
+    return reports
+
+
+def iter_synced_contracts(contracts, beedata_client, chunk_size, verify_remote=False):
+    """ Wraps contracts iterator to sync them to Beedata API in chunks. Every yielded contract has its contract_report
+    so process_contract does not need to upload it again
+    
+    :param contracts: iterator of (contractId, data) tuples as yielded by iter_contracts
+    :param beedata_client: connector to Beedata API
+    :param chunk_size: number of contracts synced together
+    :param verify_remote: check that unmodified contracts are still on Beedata API with the stored etag
+    """
+    for chunk in chunks(contracts, chunk_size):
+        reports = sync_contracts(chunk, beedata_client, verify_remote)
+        for id, data in chunk:
+            if id in reports:
+                data['contract_report'] = reports[id]
+            yield id, data
+
+
 def get_measures_dates(authorization, date_start, date_end, contract, measures_type, margindays, force_update):
     """ Return from_date for given measure type. It has to determined between authorization files, contract dates and last measure stored on MongoDB
     
@@ -364,9 +619,9 @@ def get_measures_dates(authorization, date_start, date_end, contract, measures_t
     date_start = date_converter(date_start, format=settings.DATETIME_FORMAT)
     date_end = date_converter(date_end, format=settings.DATETIME_FORMAT)
     if mongo_contract:
-        del mongo_contract['prm']
+        mongo_contract.pop('prm', None)
     
-    logger.debug('Arguments received for get dates ranges: dateStart [%s], dateEnd [%s], mongo_contract [%s], authorization [%s], type [%s]' % (date_start, date_end, mongo_contract, authorization, measures_type))
+    logger.debug('Arguments received for get dates ranges: dateStart [%s], dateEnd [%s], mongo_contract [%s], authorization [%s], type [%s]', date_start, date_end, mongo_contract, authorization, measures_type)
     if measures_type == 'PMAX' or measures_type == 'CONSOGLO':
         result['min'] = max(date_start, datetime.now() - timedelta(days=1095)) if authorization['authDay'] else None
         result['max'] = min(date_end, datetime.now() - timedelta(days=margindays)) if authorization['authDay'] else None
@@ -407,16 +662,29 @@ def get_measures_dates(authorization, date_start, date_end, contract, measures_t
         else:
             result = None 
     
-    logger.debug('Dates limits for [%s] measures: %s' % (measures_type, result))
+    logger.debug('Dates limits for [%s] measures: %s', measures_type, result)
     
     return result
 
     
+def get_types(measure_types):
+    """ Returns the list of measure types to recover for --type argument
+    
+    :param measure_types: one of PMAX, CONSOGLO, CDC, ALL or NONE
+    """
+    if measure_types == 'ALL':
+        return ['PMAX', 'CONSOGLO', 'CDC']
+    elif measure_types == 'NONE':
+        return []
+    
+    return [measure_types]
+
+
 def process_contract(id, data, customer_type, margindays, measure_types, force_update):
     """ Main function to process a single contract (upload or update contract on Beedata and add its measures too).
 
     :param id: contractId. Main connector between Enercoop and Beedata
-    :param data: contract document containing all information created on get_contracts
+    :param data: contract document containing all information created on iter_contracts
     :param customer_type: one of residential or tertiary
     :param margindays: number of days we leave as margin
     :param measure_types: measure types to recover from Enedis
@@ -432,21 +700,17 @@ def process_contract(id, data, customer_type, margindays, measure_types, force_u
     }
     
     logger.info('Processing contract: [%s]...' % id)
-    #logger.debug('Getting stored data from MongoDB...')
-    #mongo_db = connect_mongo()
-    mongo_contract = {} #mongo_db['Contracts'].find_one({'contractId': id})
-    """
+    # state was recovered in bulk before dispatching the contract
+    mongo_contract = data.get('state') or {}
     if mongo_contract:
-        for field, value in mongo_contract.items():
-            if 'ts_' in field and value and isinstance(value, str):
-                mongo_contract[field] = date_converter(value, format=settings.DATETIME_FORMAT)
-        logger.debug('Info recovered from MongoDB for contract [%s]: %s' % (id, mongo_contract))
-    else:
-        mongo_contract = {}
-    """
-    logger.debug('Deciding if contract should be POSTed or PATCHed')
+        logger.debug('Stored state recovered for contract [%s]: %s', id, mongo_contract)
     current_etag = document_etag(data['document'])
-    contract_report = upload_contract(mongo_contract, data, current_etag, beedata_client)
+    if 'contract_report' in data:
+        # contract was already synced in bulk mode
+        contract_report = data['contract_report']
+    else:
+        logger.debug('Deciding if contract should be POSTed or PATCHed')
+        contract_report = upload_contract(mongo_contract, data, current_etag, beedata_client)
     report['contract_report'] = contract_report
 
     # getting measures
@@ -459,197 +723,408 @@ def process_contract(id, data, customer_type, margindays, measure_types, force_u
     }
 
     # set measure types to recover
-    if measure_types == 'ALL':
-        types = ['PMAX', 'CONSOGLO', 'CDC']
-    elif measure_types == 'NONE':
-        types = []
-    else:
-        types = [measure_types]
+    types = get_types(measure_types)
 
-    # repeat for each measure type
+    # every measure type is recovered from Enedis on its own thread while measures already recovered are sent to Beedata
+    uploads = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    producers = []
+    failed = {}
+    types_dates = {}
+    journal = get_journal()
+    # measure types completed on this or a previous execution, contract is journaled once all of them are
+    completed = set()
     for i in types:
-        result = {}
+        if unit_key(i) in data.get('journal', ()):
+            logger.info('Measures type [%s] for contract [%s] already processed on a previous execution' % (i, id))
+            completed.add(i)
+            continue
         dates = get_measures_dates(data['auth'], data['document']['dateStart'], data['document']['dateEnd'], mongo_contract, i, margindays, force_update)
         if dates:
-            if i == 'CDC':
-                if dates['backward']:
-                    logger.info('Starting "backward" loop to recover [CDC] measures for contract [%s] from [%s] to [%s]' % (id, dates['backward']['from_date'].strftime('%d/%m/%Y'), dates['backward']['to_date'].strftime('%d/%m/%Y')))
-                    from_date = dates['backward']['to_date']
-                    to_date = from_date - timedelta(days=7)
-                    error = 0
-                    while to_date > dates['backward']['from_date']:
-                        logger.info('Recovering "backwards" [CDC] measures for contract [%s] from Enedis service: from [%s] to [%s]' % (id, to_date.strftime('%d/%m/%Y'), from_date.strftime('%d/%m/%Y')))
-                        result2 = get_data(ws_client, data, i, customer_type, to_date, from_date)
-                        recover_report = {
-                            'from_date': to_date.strftime('%d/%m/%Y'),
-                            'to_date': from_date.strftime('%d/%m/%Y'),
-                        }
-                        if 'error' not in result2:
-                            # Accumulate on 1 single document to POST
-                            if not result:
-                                result = result2
-                            else:
-                                # if there is everything created just add measurements we just recovered
-                                result['measurements'] = result['measurements'] + result2['measurements']
-                                
-                            recover_report['measures'] = len(result2['measurements'])
-                        else:
-                            recover_report['error'] = result2['error']
-                            error = 1
-                       
-                        report_results['CDC']['iterations'].append(recover_report)
-                        from_date = from_date - timedelta(days=7)
-                        to_date = to_date - timedelta(days=7)
-                        
-                        if error:
-                            break
-
-                    if result and len(result['measurements']) > 1:
-                        aux = result['measurements']
-                        report_results[i]['measures'] = len(aux)
-                        ts_min['CDC'] = sorted(aux, key=lambda j: j['timestamp'])[0]['timestamp']
-                        if not dates['forward']:
-                            ts_max['CDC'] = sorted(aux, key=lambda j: j['timestamp'])[-1]['timestamp']
-                    else:
-                        ts_min['CDC'] = mongo_contract['ts_min_CDC'] if 'ts_min_%s' % i in mongo_contract else None
-                        ts_max['CDC'] = mongo_contract['ts_max_CDC'] if 'ts_max_%s' % i in mongo_contract else None
-                        
-                if dates['forward']:
-                    from_date = dates['forward']['from_date']
-                    to_date = from_date + timedelta(days=7)
-                    error = 0
-                    logger.info('Starting "forward" loop to recover [CDC] measures for contract [%s]...' % id)
-                    while to_date < dates['forward']['to_date']:
-                        logger.info('Recovering "forward" [CDC] measures from Enedis service: from [%s] to [%s]...' % (from_date.strftime('%d/%m/%Y'), to_date.strftime('%d/%m/%Y'))) 
-                        result2 = get_data(ws_client, data, i, customer_type, from_date, to_date)
-                        recover_report = {
-                            'from_date': from_date.strftime('%d/%m/%Y'),
-                            'to_date': to_date.strftime('%d/%m/%Y'),
-                        }
-                        if 'error' not in result2:
-                            # Accumulate on 1 single document to POST
-                            if not result:
-                                result = result2
-                            else:
-                                # if there is everything created just add measurements we just recovered
-                                result['measurements'] = result['measurements'] + result2['measurements']
-                                
-                            recover_report['measures'] = len(result2['measurements'])
-                        else:
-                            recover_report['error'] = result2['error']
-                            error = 1
-                       
-                        report_results['CDC']['iterations'].append(recover_report)
-                        from_date = from_date + timedelta(days=7)
-                        to_date = to_date + timedelta(days=7)
-                        
-                        if error:
-                            break
-                        
-                    if result and len(result['measurements']) > 1:
-                        aux = result['measurements']
-                        report_results[i]['measures'] = len(aux)
-                        ts_max['CDC'] = date_converter(sorted(aux, key=lambda j: j['timestamp'])[-1]['timestamp'], format=settings.DATETIME_FORMAT)
-                    else:
-                        ts_max['CDC'] = mongo_contract['ts_max_CDC'] if 'ts_min_%s' % i in mongo_contract else None
-
-            else:
-                logger.info('Recovering [%s] measurements from Enedis service for contract [%s]...' % (i, id))
-                if dates['backward']:
-                    from_date = dates['backward']['from_date']
-                    to_date = dates['backward']['to_date']
-                    while from_date < to_date:
-                        result = fetch_backwards(
-                            i, from_date, to_date, data,
-                            customer_type, report_results, dates,
-                            ts_min, ts_max, mongo_contract
-                        )
-                        if 'error' in result and "autorisée que sur la période sur laquelle le client est détenteur du point" in result['error']:
-                            from_date = from_date + timedelta(days=30)
-                        else:
-                            break
-
-                if dates['forward']:
-                    to_date = dates['forward']['to_date']
-                    from_date = to_date - timedelta(days=365) if i == 'PMAX' else dates['forward']['from_date']
+            types_dates[i] = dates
+            failed[i] = {'backward': False, 'forward': False}
+            # until something is loaded keep previous values
+            ts_min[i] = mongo_contract['ts_min_%s' % i] if 'ts_min_%s' % i in mongo_contract else None
+            ts_max[i] = mongo_contract['ts_max_%s' % i] if 'ts_max_%s' % i in mongo_contract else None
+            producer = Thread(target=produce_measures, args=(i, dates, data, customer_type, report_results, uploads, failed[i]))
+            producer.start()
+            producers.append(producer)
+        else:
+            logger.debug('Contract [%s] does not have authorization for [%s] measures', id, i)
+            logger.info('No measures type [%s] for send to Beedata API.' % i)
+            # nothing to load for this type
+            completed.add(i)
+            if journal:
+                journal.record(id, unit_key(i))
 
-                    logger.info('Recovering "forward" [%s] measurements from Enedis service for contract [%s]: from [%s] to [%s]...' % (i, id, from_date, to_date))
-                    result2 = get_data(ws_client, data, i, customer_type, from_date, to_date)
-                    report_results[i] = {
-                        'from_date': from_date.strftime('%d/%m/%Y'),
-                        'to_date': to_date.strftime('%d/%m/%Y'),
-                    }
-                    if 'error' not in result2:
-                        # Accumulate on 1 single document to POST
-                        if not result or 'measurements' not in result:
-                            result = result2
-                        else:
-                            # if there is everything created just add measurements we just recovered
-                            result['measurements'] = result['measurements'] + result2['measurements']
-                            
-                        aux = result['measurements']
-                        report_results[i]['measures'] = len(result['measurements'])
-                        ts_max[i] = sorted(aux, key=lambda j: j['timestamp'])[-1]['timestamp']
-                    else:
-                        report_results[i]['error'] = result2['error'] 
-                        ts_max[i] = mongo_contract['ts_max_%s' % i] if 'ts_max_%s' % i in mongo_contract else None
-                    
+    def send(i, direction):
+        """ Uploads measures merged for a type and direction and moves its ts_min and ts_max """
+        batch = batches.pop((i, direction), None)
+        if not batch:
+            return
+        logger.debug('Sending [%s] data for contract [%s] to Beedata...', i, id)
+        aux = batch['doc']['measurements']
+        with metrics.timer('beedata_upload_seconds', type=i) as labels:
+            try:
+                upload = upload_measures(beedata_client, batch['doc'], backward=direction == 'backward')
+            except Exception as e:
+                # connection errors once retries are exhausted are handled as a failed upload
+                logger.exception('Unexpected error sending [%s] measures of contract [%s] to Beedata' % (i, id))
+                upload = {'status': None, 'error': str(e), 'chunks': 0, 'measures': 0, 'ts_min': None, 'ts_max': None}
+            labels['outcome'] = 'error' if upload['error'] else 'ok'
+        metrics.inc('measures_uploaded_total', upload['measures'], type=i)
+        report_results[i]['beedata_call_status'] = upload['status']
+        report_results[i]['beedata_chunks'] = report_results[i].get('beedata_chunks', 0) + upload['chunks']
+        if upload['error']:
+            failed[i][direction] = True
+            report_results[i]['beedata_call_error'] = upload['error']
+            logger.error('Error on POST measures to Beedata: %s' % upload['error'])
         else:
-            logger.debug('Contract [%s] does not have authorization for [%s] measures' % (id, i))       
-
-        logger.debug('Sending [%s] data for contract [%s] to Beedata...' % (i, id))
-        if result and 'measurements' in result and len(result['measurements']):
-            api_result = beedata_client.send_data(result, 'measures')
-            report_results[i]['beedata_call_status'] = api_result.status_code
-            if api_result.status_code != 200:
-                report_results[i]['beedata_call_error'] = api_result.text 
-                logger.error('Error on POST measures to Beedata: %s' % api_result.text)
-                # if there is an error, update ts_min and ts_max to previous values
-                logger.debug('Using previous ts_min and ts_max values because we weren\'t able to send data to Beedata API.')
-                ts_min[i] = mongo_contract['ts_min_%s' % i] if 'ts_min_%s' % i in mongo_contract else None
-                ts_max[i] = mongo_contract['ts_max_%s' % i] if 'ts_max_%s' % i in mongo_contract else None
+            logger.info('Measures type [%s] successfully sent to Beedata. Measures loaded: [%s]' % (i, len(aux)))
+            if journal:
+                for unit in batch['units']:
+                    journal.record(id, unit)
+            logger.debug('Data for type [%s] is between [%s] and [%s]', i, aux.min_timestamp(), aux.max_timestamp())
+        
+        # only contiguous data acknowledged by Beedata moves ts_min and ts_max
+        if direction == 'backward' and upload['ts_min'] is not None:
+            # chunks are sent newest first, everything since last acknowledged chunk is loaded
+            ts_min[i] = datetime.utcfromtimestamp(upload['ts_min'])
+            if not types_dates[i]['forward'] and (not ts_max[i] or ts_max[i] < datetime.utcfromtimestamp(upload['ts_max'])):
+                ts_max[i] = datetime.utcfromtimestamp(upload['ts_max'])
+        elif direction == 'forward' and upload['ts_max'] is not None:
+            # chunks are sent sorted by timestamp, everything until last acknowledged chunk is loaded
+            ts_max[i] = datetime.utcfromtimestamp(upload['ts_max'])
+
+    # contiguous documents (CDC windows) of the same type and direction are merged until they fill a Beedata chunk
+    batches = {}
+    finished = 0
+    try:
+        while finished < len(producers):
+            job = uploads.get()
+            if job.get('finished'):
+                finished += 1
+                for direction in ['backward', 'forward']:
+                    send(job['type'], direction)
+                if job['complete'] and not any(failed[job['type']].values()):
+                    completed.add(job['type'])
+                    if journal:
+                        journal.record(id, unit_key(job['type']))
+                continue
+            
+            i = job['type']
+            direction = job['direction']
+            if failed[i][direction]:
+                logger.debug('Skipping [%s] "%s" measures for contract [%s] because a previous upload failed', i, direction, id)
+                continue
+            
+            batch = batches.get((i, direction))
+            if batch and len(batch['doc']['measurements']) + len(job['doc']['measurements']) > settings.BEEDATA_MEASURES_CHUNK_SIZE:
+                # merged measures would not fit on a single chunk
+                send(i, direction)
+                batch = None
+            if failed[i][direction]:
+                continue
+            if batch:
+                batch['doc']['measurements'].extend(job['doc']['measurements'])
             else:
-                aux = result['measurements']
-                logger.info('Measures type [%s] successfully sent to Beedata. Measures loaded: [%s]' % (i, len(aux)))
-                logger.debug('Data for type [%s] is between [%s] and [%s]' % (i, sorted(aux, key=lambda j: j['timestamp'])[0]['timestamp'], sorted(aux, key=lambda j: j['timestamp'])[-1]['timestamp']))
-        else:
-            logger.info('No measures type [%s] for send to Beedata API.' % i)
+                batch = batches[(i, direction)] = {'doc': job['doc'], 'units': []}
+            if job.get('unit'):
+                batch['units'].append(job['unit'])
+    finally:
+        if finished < len(producers):
+            # stopped by an unexpected error: producers stop recovering measures and are unblocked until they finish
+            for directions in failed.values():
+                directions['backward'] = directions['forward'] = True
+            while finished < len(producers):
+                if uploads.get().get('finished'):
+                    finished += 1
+        for producer in producers:
+            producer.join()
 
     report['measures_report'] = report_results
-    logger.info('Updating mongo contract with ts_min values [%s] and ts_max values [%s]' % (ts_min, ts_max))
-    #update_mongo_contract(mongo_db, id, ts_min, ts_max, current_etag, data['csv'][settings.CONTRACT_COLUMNS['meteringPointId']])
+    if state_store:
+        logger.info('Updating contract state with ts_min values [%s] and ts_max values [%s]' % (ts_min, ts_max))
+        # contract etag is only updated if it is on Beedata API, so it is uploaded again on next execution otherwise
+        state_store.save(id, ts_min, ts_max, current_etag if contract_synced(contract_report) else None,
+                         data['csv'][settings.CONTRACT_COLUMNS['meteringPointId']], contract_report.get('remote_etag'))
+    if journal and completed.issuperset(types) and contract_synced(contract_report):
+        # contract is skipped on resume only if nothing is left: measures pending or contract not uploaded are retried
+        journal.record(id, CONTRACT_UNIT)
     report['finish'] = datetime.now()
+    metrics.observe('contract_seconds', (report['finish'] - report['start']).total_seconds())
     logger.info('Loop for contract [%s] finished.' % id)
     
     return report
 
 
-def fetch_backwards(measure_type, from_date, to_date, data, customer_type, report_results, dates, ts_min, ts_max, mongo_contract):
+def upload_measures(beedata_client, result, backward=False):
+    """ Sends measures document to Beedata in chunks of settings.BEEDATA_MEASURES_CHUNK_SIZE measurements
+    (and settings.BEEDATA_MEASURES_CHUNK_BYTES bytes) sorted by timestamp. It stops on first chunk with error
+    
+    :param beedata_client: connector to Beedata API
+    :param result: measures document built by get_data
+    :param backward: True to send newest chunks first
+    
+    :return dict with last status, error, chunks sent and measures acknowledged with their first and last timestamps (epoch seconds)
+    """
+    upload = {
+        'status': None,
+        'error': None,
+        'chunks': 0,
+        'measures': 0,
+        'ts_min': None,
+        'ts_max': None
+    }
+    for body, count, first, last in iter_measures_chunks(result, settings.BEEDATA_MEASURES_CHUNK_SIZE, settings.BEEDATA_MEASURES_CHUNK_BYTES, reverse=backward):
+        api_result = beedata_client.send_body(body, 'measures')
+        upload['status'] = api_result.status_code
+        upload['chunks'] += 1
+        if api_result.status_code != 200:
+            upload['error'] = api_result.text
+            break
+        upload['measures'] += count
+        # chunks are sent in order, so acknowledged measures are always contiguous
+        if upload['ts_min'] is None or first < upload['ts_min']:
+            upload['ts_min'] = first
+        if upload['ts_max'] is None or last > upload['ts_max']:
+            upload['ts_max'] = last
+        logger.debug('Chunk of [%s] measures from [%s] to [%s] acknowledged by Beedata', count, format_timestamp(first), format_timestamp(last))
+    
+    return upload
+
+
+# CDC windows are aligned on 7 days steps from this date (a Monday), so they are the same whatever the execution day is
+CDC_WINDOWS_EPOCH = datetime(2000, 1, 3)
+CDC_WINDOWS_STEP = timedelta(days=7)
+
+
+def plan_cdc_windows(dates, backward):
+    """ Returns every 7 days window needed to recover CDC measures between given dates, ordered as they have to be loaded.
+    Windows are aligned to CDC_WINDOWS_EPOCH so their cache and journal keys do not change from one day to another.
+    Backward windows go from to_date to the past and forward windows from from_date to the future. First window is cut
+    on to_date (backward) or from_date (forward) and last partial window is not included
+    
+    :param dates: dict with from_date and to_date
+    :param backward: True to start from to_date, False to start from from_date
+    
+    :return list of (from_date, to_date) tuples
+    """
+    windows = []
+    if backward:
+        to_date = dates['to_date']
+        from_date = CDC_WINDOWS_EPOCH + ((to_date - CDC_WINDOWS_EPOCH) // CDC_WINDOWS_STEP) * CDC_WINDOWS_STEP
+        if from_date == to_date:
+            from_date = to_date - CDC_WINDOWS_STEP
+        while from_date > dates['from_date']:
+            windows.append((from_date, to_date))
+            to_date = from_date
+            from_date = from_date - CDC_WINDOWS_STEP
+    else:
+        from_date = dates['from_date']
+        to_date = CDC_WINDOWS_EPOCH + ((from_date - CDC_WINDOWS_EPOCH) // CDC_WINDOWS_STEP + 1) * CDC_WINDOWS_STEP
+        while to_date < dates['to_date']:
+            windows.append((from_date, to_date))
+            from_date = to_date
+            to_date = to_date + CDC_WINDOWS_STEP
+    
+    return windows
+
+
+def fetch_windows(data, measure_type, customer_type, windows):
+    """ Recovers measures from Enedis for every window with up to settings.ENEDIS_WINDOW_CONCURRENCY concurrent requests.
+    Results are yielded in windows order and it stops after first window with error, so only contiguous data is returned
+    
+    :param data: contract document containing all information created on iter_contracts
+    :param measure_type: one of PMAX, CDC, CONSOGLO
+    :param customer_type: one of residential or tertiary
+    :param windows: list of (from_date, to_date) tuples as returned by plan_cdc_windows
+    
+    :return generator of ((from_date, to_date), result) tuples
+    """
+    if enedis_async:
+        yield from fetch_windows_async(data, measure_type, customer_type, windows)
+        return
+    
+    @profiled()
+    def fetch(window):
+        logger.info('Recovering [%s] measures for contract [%s] from Enedis service: from [%s] to [%s]' % (measure_type, data['document']['contractId'], window[0].strftime('%d/%m/%Y'), window[1].strftime('%d/%m/%Y')))
+        return get_data(ws_client, data, measure_type, customer_type, window[0], window[1])
+    
+    executor = ThreadPoolExecutor(max_workers=settings.ENEDIS_WINDOW_CONCURRENCY)
+    pending = deque()
+    windows = iter(windows)
+    try:
+        for window in islice(windows, settings.ENEDIS_WINDOW_CONCURRENCY):
+            pending.append((window, executor.submit(fetch, window)))
+        while pending:
+            window, future = pending.popleft()
+            result = future.result()
+            yield window, result
+            if 'error' in result:
+                break
+            for window in islice(windows, 1):
+                pending.append((window, executor.submit(fetch, window)))
+    finally:
+        # windows after an error are not needed anymore
+        for window, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def fetch_windows_async(data, measure_type, customer_type, windows):
+    """ Same than fetch_windows with asyncio Enedis client: up to settings.ENEDIS_ASYNC_CONCURRENCY windows are
+    coroutines of an event loop run by current thread, sharing a single aiohttp session. Requests go through the
+    same throttle, retries and responses cache than get_data
+    
+    :param data: contract document containing all information created on iter_contracts
+    :param measure_type: one of PMAX, CDC, CONSOGLO
+    :param customer_type: one of residential or tertiary
+    :param windows: list of (from_date, to_date) tuples as returned by plan_cdc_windows
+    
+    :return generator of ((from_date, to_date), result) tuples
+    """
+    def fetch(window):
+        logger.info('Recovering [%s] measures for contract [%s] from Enedis service: from [%s] to [%s]' % (measure_type, data['document']['contractId'], window[0].strftime('%d/%m/%Y'), window[1].strftime('%d/%m/%Y')))
+        return loop.create_task(async_get_data(service, data, measure_type, customer_type, window[0], window[1]))
+    
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    session = None
+    pending = deque()
+    windows = iter(windows)
+    try:
+        service, session = loop.run_until_complete(init_async_webservice_client())
+        for window in islice(windows, settings.ENEDIS_ASYNC_CONCURRENCY):
+            pending.append((window, fetch(window)))
+        while pending:
+            window, task = pending.popleft()
+            result = loop.run_until_complete(task)
+            yield window, result
+            if 'error' in result:
+                break
+            for window in islice(windows, 1):
+                pending.append((window, fetch(window)))
+    finally:
+        # windows after an error are not needed anymore
+        for window, task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*[task for window, task in pending], return_exceptions=True))
+        if session:
+            loop.run_until_complete(session.close())
+        loop.close()
+
+
+def fetch_range(measure_type, from_date, to_date, data, customer_type, report_results):
+    """ Recovers PMAX or CONSOGLO measures for a date range with a single Enedis call and reports it
+    
+    :param measure_type: one of PMAX, CONSOGLO
+    :param from_date: where request start
+    :param to_date: where request finish
+    :param data: contract document containing all information created on iter_contracts
+    :param customer_type: one of residential or tertiary
+    :param report_results: measures report for the contract
+    """
     logger.info(
-        'Recovering "backwards" [%s] measurements from Enedis service for contract [%s]: from [%s] to [%s]...' % (
-        measure_type, id, from_date, to_date))
+        'Recovering [%s] measurements from Enedis service for contract [%s]: from [%s] to [%s]...' % (
+        measure_type, data['document']['contractId'], from_date, to_date))
     result = get_data(ws_client, data, measure_type, customer_type, from_date, to_date)
-    report_results[measure_type] = {
+    report_results[measure_type].update({
         'from_date': from_date.strftime('%d/%m/%Y'),
         'to_date': to_date.strftime('%d/%m/%Y'),
-    }
+    })
     if 'error' not in result:
-        aux = result['measurements']
         report_results[measure_type]['measures'] = len(result['measurements'])
-        ts_min[measure_type] = sorted(aux, key=lambda j: j['timestamp'])[0]['timestamp']
-        if not dates['forward']:
-            ts_max[measure_type] = sorted(aux, key=lambda j: j['timestamp'])[-1][
-                'timestamp']
     else:
-        ts_min[measure_type] = mongo_contract[
-            'ts_min_%s' % measure_type] if 'ts_min_%s' % measure_type in mongo_contract else None
-        if not dates['forward']:
-            ts_max[measure_type] = mongo_contract[
-                'ts_max_%s' % measure_type] if 'ts_max_%s' % measure_type in mongo_contract else None
         report_results[measure_type]['error'] = result['error']
+    
     return result
 
 
+@profiled()
+def produce_measures(measure_type, dates, data, customer_type, report_results, uploads, failed):
+    """ Recovers every measure needed for a type from Enedis and puts them on uploads queue as soon as they are available.
+    Backward measures are put from newest to oldest and forward ones from oldest to newest, stopping on first error.
+    Units already completed on a previous execution (journal field) are not recovered again.
+    A finished message is put once everything is recovered, complete if there was no error
+    
+    :param measure_type: one of PMAX, CDC, CONSOGLO
+    :param dates: dates limits returned by get_measures_dates
+    :param data: contract document containing all information created on iter_contracts
+    :param customer_type: one of residential or tertiary
+    :param report_results: measures report for the contract
+    :param uploads: queue where measures documents are put
+    :param failed: dict set by the consumer when a direction upload failed, recovering more measures for it is useless
+    """
+    id = data['document']['contractId']
+    done = data.get('journal', ())
+    complete = True
+    try:
+        cache = get_cache()
+        if cache and cache.replay:
+            # every measure is rebuilt from cached Enedis responses whatever dates are
+            result = get_cached_data(data, measure_type)
+            if 'error' in result:
+                complete = False
+                logger.warning(result['error'])
+                report_results[measure_type]['error'] = result['error']
+            else:
+                report_results[measure_type]['measures'] = len(result['measurements'])
+                uploads.put({'type': measure_type, 'direction': 'backward', 'doc': result})
+            return
+        
+        if measure_type == 'CDC':
+            for direction in ['backward', 'forward']:
+                if not dates[direction]:
+                    continue
+                logger.info('Starting "%s" loop to recover [CDC] measures for contract [%s] from [%s] to [%s]' % (direction, id, dates[direction]['from_date'].strftime('%d/%m/%Y'), dates[direction]['to_date'].strftime('%d/%m/%Y')))
+                windows = [window for window in plan_cdc_windows(dates[direction], backward=direction == 'backward') if unit_key(measure_type, direction, window) not in done]
+                for (from_date, to_date), result in fetch_windows(data, measure_type, customer_type, windows):
+                    if failed[direction]:
+                        break
+                    recover_report = {
+                        'from_date': from_date.strftime('%d/%m/%Y'),
+                        'to_date': to_date.strftime('%d/%m/%Y'),
+                    }
+                    if 'error' not in result:
+                        recover_report['measures'] = len(result['measurements'])
+                        report_results[measure_type]['measures'] = report_results[measure_type].get('measures', 0) + len(result['measurements'])
+                        uploads.put({'type': measure_type, 'direction': direction, 'doc': result, 'unit': unit_key(measure_type, direction, (from_date, to_date))})
+                    else:
+                        complete = False
+                        recover_report['error'] = result['error']
+                    report_results[measure_type]['iterations'].append(recover_report)
+        else:
+            if dates['backward'] and unit_key(measure_type, 'backward') not in done:
+                result = {}
+                from_date = dates['backward']['from_date']
+                to_date = dates['backward']['to_date']
+                while from_date < to_date:
+                    result = fetch_range(measure_type, from_date, to_date, data, customer_type, report_results)
+                    if 'error' in result and "autorisée que sur la période sur laquelle le client est détenteur du point" in result['error']:
+                        from_date = from_date + timedelta(days=30)
+                    else:
+                        break
+                if result and 'error' not in result:
+                    uploads.put({'type': measure_type, 'direction': 'backward', 'doc': result, 'unit': unit_key(measure_type, 'backward')})
+                else:
+                    complete = False
+
+            if dates['forward'] and unit_key(measure_type, 'forward') not in done:
+                to_date = dates['forward']['to_date']
+                from_date = to_date - timedelta(days=365) if measure_type == 'PMAX' else dates['forward']['from_date']
+                result = fetch_range(measure_type, from_date, to_date, data, customer_type, report_results)
+                if 'error' not in result:
+                    uploads.put({'type': measure_type, 'direction': 'forward', 'doc': result, 'unit': unit_key(measure_type, 'forward')})
+                else:
+                    complete = False
+    except Exception as e:
+        complete = False
+        logger.exception('Unexpected error recovering [%s] measures for contract [%s]' % (measure_type, id))
+        report_results[measure_type]['error'] = str(e)
+    finally:
+        uploads.put({'type': measure_type, 'finished': True, 'complete': complete})
+
+
 def document_etag(value):
     """ Creates a value that will be used to know if contract has changed or not since last execution
     
@@ -658,30 +1133,3 @@ def document_etag(value):
     h = hashlib.sha1()
     h.update(dumps(value, sort_keys=True).encode("utf-8"))
     return h.hexdigest()
-    
-    
-def update_mongo_contract(mongo_db, id, ts_min, ts_max, etag, prm):
-    """ Saves to mongo the contract information once it has been processed
-    
-    :param mongo_db: MongoDB connector
-    :param id: contractId
-    :param ts_min: dict containing first recovered measure 
-    :param ts_max: dict containing last recovered measure 
-    :param etag: contract document etag of last CSV
-    :param prm: contract prm
-    """
-    doc = {
-        'contractId': id,
-        'etag': etag,
-        'prm': prm,
-        'meteringPointId': encode(prm),
-        'last_op': datetime.now()
-    }        
-    for i in ['PMAX', 'CONSOGLO', 'CDC']:
-        if i in ts_min and ts_min[i]:
-            doc['ts_min_%s' % i] = ts_min[i]
-        if i in ts_max and ts_max[i]:
-            doc['ts_max_%s' % i] = ts_max[i]
-            
-    mongo_db['Contracts'].find_and_modify({'contractId': id}, {'$set': doc}, upsert=True)
-    logger.debug('MongoDB contract [%s] successfully saved with last modification dates: [%s]' % (id, doc))
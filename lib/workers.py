@@ -0,0 +1,123 @@
+# encoding: utf-8
+
+# utils imports
+import logging
+import multiprocessing
+from multiprocessing.util import Finalize
+
+# custom imports
+import settings
+from lib import utils
+from lib.log import setup_logger
+from lib.metrics import metrics
+from lib.profiler import Profiler, set_profiler, get_profiler, profiled
+from lib.ratelimit import set_throttle
+from lib.beedata_connector import set_token_manager
+from lib.cache import ResponseCache, set_cache
+from lib.journal import Journal, set_journal
+from lib.enedis_connector import load_wsdl_client
+
+logger = logging.getLogger("app")
+
+# options received by this process on init_worker
+_options = {}
+
+
+def init_worker(options):
+    """ Initializes a worker process: logging, shared Enedis throttle and clients (Enedis, Beedata and MongoDB) are
+    created once and reused for every contract processed by this process. It works with any start method
+
+    :param options: dict with loglevel, log_file, margindays, type, forceupdate, throttle, token, state, cache, replay, journal, profile and async
+    """
+    _options.clear()
+    _options.update(options)
+    if not logger.handlers:
+        # spawned processes do not inherit parent handlers
+        setup_logger(options['loglevel'], options['log_file'], mode='a', payload_sample=settings.LOG_PAYLOAD_SAMPLE,
+                     payload_max_chars=settings.LOG_PAYLOAD_MAX_CHARS)
+    set_throttle(options.get('throttle'))
+    set_token_manager(options.get('token'))
+    set_journal(Journal(options['journal']) if options.get('journal') else None)
+    replay = options.get('replay', False)
+    set_cache(ResponseCache(replay=replay) if options.get('cache') or replay else None)
+    # Enedis is not used replaying cached responses
+    utils.init_clients(enedis=options['type'] != 'NONE' and not replay, state=options.get('state', 'NONE'), use_async=options.get('async', False))
+    # pending contracts state is written when the worker exits
+    Finalize(None, utils.close_clients, exitpriority=10)
+    if options.get('profile'):
+        profiler = Profiler(options['profile'])
+        set_profiler(profiler)
+        Finalize(None, profiler.dump, exitpriority=10)
+    else:
+        set_profiler(None)
+    logger.debug('Worker initialized.')
+
+
+def process_item(item):
+    """ Processes a single contract with the clients of this process
+
+    :param item: (contractId, data) tuple as yielded by iter_contracts
+
+    :return (contractId, result, metrics) tuple, metrics recorded by this process while processing it
+    """
+    id, data = item
+    metrics.pop_stages()
+    with profiled():
+        result = utils.process_contract(
+            id,
+            data,
+            data['contract_type'],
+            _options['margindays'],
+            _options['type'],
+            _options['forceupdate']
+        )
+    if result and 'expected_cost' in data:
+        result['expected_cost'] = data['expected_cost']
+    stages = metrics.pop_stages()
+    if result and get_profiler():
+        result['stages'] = stages
+
+    return id, result, metrics.collect()
+
+
+def run_workers(contracts, options, processes=1, chunksize=1, start_method=None):
+    """ Processes every contract on a pool of persistent workers and yields results as soon as they are available.
+    With a single process contracts are processed on current process
+
+    :param contracts: iterator of (contractId, data) tuples
+    :param options: dict passed to init_worker
+    :param processes: number of worker processes
+    :param chunksize: number of contracts sent together to a worker
+    :param start_method: multiprocessing start method (fork, spawn or forkserver). Default to platform one
+
+    :return generator of (contractId, result) tuples
+    """
+    if processes == 1:
+        init_worker(options)
+        try:
+            for item in contracts:
+                id, result, snapshot = process_item(item)
+                metrics.merge(snapshot)
+                yield id, result
+        finally:
+            utils.close_clients()
+            if get_profiler():
+                get_profiler().dump()
+        return
+
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == 'fork' and options['type'] != 'NONE' and not options.get('replay'):
+        # WSDL is parsed once and inherited by every worker
+        load_wsdl_client()
+    pool = context.Pool(processes=processes, initializer=init_worker, initargs=(options,))
+    try:
+        for id, result, snapshot in pool.imap_unordered(process_item, contracts, chunksize=chunksize):
+            # metrics of every worker are added on this process
+            metrics.merge(snapshot)
+            yield id, result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -14,10 +14,57 @@ BEEDATA_ENDPOINTS = {
     'measures': 'v1/amon_measures'
 }
 
+# Seconds a Beedata token is valid and seconds before its expiration when it is renewed
+BEEDATA_TOKEN_TTL = 3600
+BEEDATA_TOKEN_REFRESH_MARGIN = 300
+
+# Beedata HTTP connections pool (one pool per worker) and retries for every request
+BEEDATA_POOL_CONNECTIONS = 1
+BEEDATA_POOL_SIZE = 10
+BEEDATA_RETRIES = 5
+BEEDATA_BACKOFF_FACTOR = 0.5
+BEEDATA_RETRY_STATUS = [500, 502, 503, 504]
+
+# Default number of contracts synced together when bulk mode is enabled (--contractsbulk)
+BEEDATA_CONTRACTS_CHUNK_SIZE = 50
+
+# Measures are sent to Beedata in chunks of at most these measurements / bytes
+BEEDATA_MEASURES_CHUNK_SIZE = 10000
+BEEDATA_MEASURES_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Measures documents recovered from Enedis waiting to be sent to Beedata (per contract). Enedis calls wait when it is full
+PIPELINE_QUEUE_SIZE = 4
+
+# Cost scheduler (--schedule COST): contracts sorted together and initial guess of seconds per Enedis call
+SCHEDULER_WINDOW = 5000
+SCHEDULER_SECONDS_PER_CALL = 2
+
 # Enedis Webservice settings 
 ENEDIS_LOGIN_USER = ''
 ENEDIS_LOGIN_PASSWORD = ''
 WSDL_PATH = 'Enercoop/ConsultationMesuresDetaillees-v1.0.wsdl'
+ENEDIS_URL = ''  # default to https://sge-b2b.enercoop.org/
+
+# Max number of CDC 7 days windows recovered at the same time for a single contract
+ENEDIS_WINDOW_CONCURRENCY = 4
+# Same with asyncio Enedis client (--enedisasync YES), windows are coroutines sharing a single connection pool
+ENEDIS_ASYNC_CONCURRENCY = 16
+
+# Enedis requests budget shared by every process (requests/second, 0 to disable) and adaptive concurrency (AIMD) limits
+ENEDIS_RATE_LIMIT = 10
+ENEDIS_CONCURRENCY_INITIAL = 4
+ENEDIS_CONCURRENCY_MIN = 1
+ENEDIS_CONCURRENCY_MAX = 32
+ENEDIS_LATENCY_TARGET = 10  # seconds
+# Requests rejected with these HTTP status (or timeouts) are retried with backoff instead of losing the range
+ENEDIS_THROTTLE_STATUS = [429, 502, 503, 504]
+ENEDIS_THROTTLE_RETRIES = 3
+ENEDIS_THROTTLE_BACKOFF = 2  # seconds
+
+# Enedis responses cache (--enediscache YES, --replay YES): directory, seconds a response is used and max size in bytes
+ENEDIS_CACHE_PATH = 'enedis_cache'
+ENEDIS_CACHE_TTL = 30 * 24 * 3600
+ENEDIS_CACHE_MAX_BYTES = 2 * 1024 ** 3
 
 
 # Enedis required request fields
@@ -31,6 +78,15 @@ MONGO_DBNAME = ''
 MONGO_USERNAME = ''
 MONGO_PASSWORD = ''
 
+# Contracts state (--state MONGO): contracts whose state is recovered together (0 loads the whole collection at once)
+# and buffered checkpoints written every STATE_FLUSH_SIZE contracts or STATE_FLUSH_INTERVAL seconds
+STATE_LOAD_BATCH = 1000
+STATE_FLUSH_SIZE = 500
+STATE_FLUSH_INTERVAL = 30
+# Contracts state (--state SQLITE): local file shared by every worker and seconds a writer waits for the lock
+STATE_SQLITE_PATH = 'state.sqlite3'
+STATE_SQLITE_TIMEOUT = 30
+
 # PRM/PDL security 
 ANONYMIZE_KEY = ''
 
@@ -45,6 +101,34 @@ HOURS_DATETIME_FORMAT = '%d/%m/%Y'
 
 
 
+# Journal of completed contracts, measure types and windows used by --resume ('' to disable)
+# and if every line is synced to disk
+JOURNAL_PATH = 'journal.ndjson'
+JOURNAL_FSYNC = False
+
+
+# Contract results written together to the report
+REPORT_FLUSH_SIZE = 100
+
+
+# Metrics (Prometheus text format) written next to the log file every METRICS_EXPORT_EVERY contracts and at the end.
+# Latency histograms buckets in seconds
+METRICS_PREFIX = 'enercoop_loader_'
+METRICS_EXPORT_EVERY = 100
+METRICS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+# Profiling (--profile YES): slowest contracts and functions listed on the merged report
+PROFILE_TOP_CONTRACTS = 20
+PROFILE_TOP_FUNCTIONS = 40
+
+
+# Big payloads (documents, Enedis responses and SOAP envelopes) logged on DEBUG: only one of every LOG_PAYLOAD_SAMPLE
+# is logged, truncated to LOG_PAYLOAD_MAX_CHARS characters (0 for no limit)
+LOG_PAYLOAD_SAMPLE = 10
+LOG_PAYLOAD_MAX_CHARS = 2000
+
+
 # Other
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 CONTRACT_COLUMNS = {
@@ -2,101 +2,147 @@
 
 # utils imports
 import argparse
-import logging
+import multiprocessing
 from datetime import datetime
-from multiprocessing import Pool
 
 
 # custom imports
-from lib.utils import get_contracts, process_contract, connect_mongo
-#from lib.report import Report
+import settings
+from lib.log import setup_logger
+from lib.ratelimit import Throttle
+from lib.beedata_connector import BaseClient, TokenManager, set_token_manager
+from lib.utils import iter_contracts, iter_synced_contracts, connect_mongo
+from lib.state import get_state_store, iter_with_state
+from lib.journal import Journal, load_journal, iter_pending
+from lib.workers import run_workers
+from lib.scheduler import iter_longest_first, CostModel
+from lib.report import Report, MongoReportWriter, NDJSONReportWriter
+from lib.metrics import metrics
+from lib.profiler import SlowestContracts, write_profile_report
 
 
-#mongo_db = connect_mongo()
-#report = Report(mongo_db)
-
-
-def setup_logger(args):
-    loglevel = args.loglevel.upper()
-    numeric_level = getattr(logging, loglevel, None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % loglevel)
-    logger = logging.getLogger("app")
-    logger.setLevel(numeric_level)
-    formatter = logging.Formatter('PID [%(process)d] - %(asctime)s - %(levelname)s - %(message)s')
-    
-    # File handler to output to .log file
-    log_file = "beedata_script_%s.log" % datetime.now().strftime("%Y-%m-%dT%H_%M_%SZ")
-    ch = logging.FileHandler(log_file, 'w', 'utf-8')
-    ch.setLevel(numeric_level)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    # Stream handler to output to CLI
-    sh = logging.StreamHandler()
-    sh.setLevel(numeric_level)
-    sh.setFormatter(formatter)
-    logger.addHandler(sh)
-    
-    
-    logging.getLogger("zeep").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
-    
-    return logger
-
-
-
-def multi_load(item):
-    margindays = args.margindays
-    measure_types = args.type
-    force_update = args.forceupdate
-
-    result = process_contract(
-        item['contract'], 
-        item['data'], 
-        item['type'],
-        margindays,
-        measure_types,
-        force_update
-    )
-    
-    #if result:
-    #    report.add_results(item['contract'], result)
-
 def run(args):
     """Main thread. Get parameters from CLI and decides when to run with single thread or using multiprocess
     
     :param args: argparse arguments containing, at least: contracts, authorizations and hours files path, processes and margindays
     """
-    logger = setup_logger(args)
+    log_file = "beedata_script_%s.log" % datetime.now().strftime("%Y-%m-%dT%H_%M_%SZ")
+    logger = setup_logger(args.loglevel, log_file, payload_sample=settings.LOG_PAYLOAD_SAMPLE, payload_max_chars=settings.LOG_PAYLOAD_MAX_CHARS)
     logger.info('Starting script... ')
     
-    contracts = get_contracts(args)
-    #report.add_num_contracts(len(contracts.keys()))
+    # objects shared with workers are created with the same start method than the pool
+    context = multiprocessing.get_context(args.startmethod)
+    
+    # Beedata token shared by this process and every worker, only one of them logs in
+    token_manager = TokenManager(context=context)
+    set_token_manager(token_manager)
+    
+    # contracts are read lazily from CSV files, one document at a time
+    contracts = iter_contracts(args)
+    if settings.JOURNAL_PATH:
+        if args.resume:
+            logger.info('Resuming previous execution from journal [%s]' % settings.JOURNAL_PATH)
+            contracts = iter_pending(contracts, load_journal())
+        else:
+            # new execution, previous journal is discarded
+            Journal(truncate=True).close()
+    state_store = None
+    if args.state != 'NONE':
+        logger.info('Recovering contracts state from [%s]' % args.state)
+        state_store = get_state_store(args.state, connect_mongo() if args.state == 'MONGO' else None)
+        contracts = iter_with_state(contracts, state_store)
+    if args.contractsbulk or args.verifyremote:
+        logger.info('Syncing contracts to Beedata in chunks of [%s]' % settings.BEEDATA_CONTRACTS_CHUNK_SIZE)
+        if args.verifyremote:
+            logger.info('Unmodified contracts will be checked against Beedata API')
+        contracts = iter_synced_contracts(contracts, BaseClient(), settings.BEEDATA_CONTRACTS_CHUNK_SIZE, args.verifyremote)
+    
+    throttle = None
+    if args.replay:
+        logger.info('Replaying Enedis responses from cache [%s]. No requests to Enedis will be done' % settings.ENEDIS_CACHE_PATH)
+    elif args.enedisrate:
+        # created before starting workers so every process shares the same budget
+        logger.info('Enedis requests limited to [%s] requests/second' % args.enedisrate)
+        throttle = Throttle(args.enedisrate, settings.ENEDIS_CONCURRENCY_INITIAL, settings.ENEDIS_CONCURRENCY_MIN,
+                            settings.ENEDIS_CONCURRENCY_MAX, settings.ENEDIS_LATENCY_TARGET, context)
     
-    margindays = args.margindays
-    measure_types = args.type
-    force_update = args.forceupdate
+    # options used by every worker to create its clients and process contracts
+    options = {
+        'loglevel': args.loglevel,
+        'log_file': log_file,
+        'margindays': args.margindays,
+        'type': args.type,
+        'forceupdate': args.forceupdate,
+        'throttle': throttle,
+        'token': token_manager,
+        'state': args.state,
+        'cache': args.enediscache,
+        'replay': args.replay,
+        'journal': settings.JOURNAL_PATH,
+        'profile': None,
+        'async': args.enedisasync
+    }
+    slowest = None
+    if args.profile:
+        # every worker dumps its own profile there, they are merged once every worker has finished
+        options['profile'] = log_file.replace('beedata_script_', 'beedata_profile_').replace('.log', '')
+        logger.info('Profiling workers on [%s]' % options['profile'])
+        slowest = SlowestContracts()
+
+    chunksize = args.chunksize
+    cost_model = None
+    if args.schedule == 'COST':
+        # longest contracts first, one by one so idle workers always take the next pending one
+        logger.info('Scheduling contracts by expected cost')
+        contracts = iter_longest_first(contracts, options)
+        chunksize = 1
+        cost_model = CostModel()
 
     # process every contract (row on the CSV)
     if args.processes == 1:
         logger.info('Processing files with single thread')
-        for contract, data in contracts.items():
-            result = process_contract(contract, data, data['contract_type'], #mongo_db, ws_client, beedata_client, 
-                                      margindays, measure_types, force_update)
-            #if result:
-            #    report.add_results(contract, result)
     else:
-        logger.info('Processing files with [%s] threads' % args.processes)
-        dict_list = []
-        for contract, data in contracts.items():
-            dict_list.append({
-                'contract': contract,
-                'data': data,
-                'type': data['contract_type']
-            })
-        pool = Pool(processes=int(args.processes))
-        pool.map(multi_load, dict_list)
-    #report.finish()
+        logger.info('Processing files with [%s] processes' % args.processes)
+    metrics_file = log_file.replace('beedata_script_', 'beedata_metrics_').replace('.log', '.prom')
+    # results are received from workers and written by this process in batches
+    report = None
+    if args.report == 'MONGO':
+        report = Report(MongoReportWriter(connect_mongo()))
+    elif args.report == 'NDJSON':
+        report = Report(NDJSONReportWriter(log_file.replace('beedata_script_', 'beedata_report_').replace('.log', '.ndjson')))
+    num_contracts = 0
+    processed = 0
+    try:
+        for contract, result in run_workers(contracts, options, args.processes, chunksize, args.startmethod):
+            # every contract read from the CSV, including the ones with errors that are not processed
+            num_contracts += 1
+            if result:
+                processed += 1
+                if cost_model:
+                    cost_model.update(contract, result.get('expected_cost'), result)
+                if report:
+                    report.add_results(contract, result)
+                if slowest:
+                    slowest.add(contract, result)
+                if processed % settings.METRICS_EXPORT_EVERY == 0:
+                    metrics.export(metrics_file)
+    except BaseException:
+        if report:
+            report.add_num_contracts(num_contracts)
+            report.interrupt()
+        raise
+    finally:
+        if state_store:
+            state_store.close()
+    if report:
+        report.add_num_contracts(num_contracts)
+        report.finish()
+    logger.info('Contracts processed: [%s]' % processed)
+    metrics.log_summary()
+    metrics.export(metrics_file)
+    logger.info('Metrics written to [%s]' % metrics_file)
+    if slowest:
+        logger.info('Profile report written to [%s]' % write_profile_report(options['profile'], slowest))
     logger.info('Script finished. ')
     
     
@@ -114,16 +160,52 @@ if __name__ == '__main__':
                         help='Log Level. Can be set to DEBUG, INFO, WARNING or ERROR')
     parser.add_argument('--processes', type=int, default=1,
                         help='Number of threads used to process (max should be lower than the number of cores available). Default to 1.')
+    parser.add_argument('--chunksize', type=int, default=1,
+                        help='Number of contracts sent together to a process. Default to 1.')
+    parser.add_argument('--startmethod', type=str, choices=['fork', 'spawn', 'forkserver'], default=None,
+                        help='Processes start method. Default to platform one.')
+    parser.add_argument('--schedule', type=str, choices=['FIFO', 'COST'], default='FIFO',
+                        help='FIFO processes contracts in CSV order. COST dispatches the most expensive ones first (expected Enedis calls).')
+    parser.add_argument('--state', type=str, choices=['NONE', 'MONGO', 'SQLITE'], default='NONE',
+                        help='Where contracts state (last measures loaded and etag) is kept between executions. With NONE every measure is recovered again.')
     parser.add_argument('--margindays', type=int, default=10,
                         help='Number of days to let some margin. It will set "top" date as: today - margindays. Default to 10.')
     parser.add_argument('--type', type=str, choices=['PMAX', 'CONSOGLO', 'CDC', 'ALL', 'NONE'], default='ALL',
                         help='Measures type to recover.')
     parser.add_argument('--forceupdate', type=str, choices=['YES', 'NO'], default='NO',
                         help='Force update ignoring stored dates from database.')
+    parser.add_argument('--contractsbulk', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Sync contracts to Beedata in chunks (etags recovered and new contracts created in bulk).')
+    parser.add_argument('--enediscache', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Keep Enedis responses on a local compressed cache (ENEDIS_CACHE_PATH) and reuse them while they are not expired.')
+    parser.add_argument('--replay', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Rebuild and upload measures only from Enedis responses cache, without any request to Enedis. Implies --forceupdate YES.')
+    parser.add_argument('--report', type=str, choices=['NONE', 'MONGO', 'NDJSON'], default='NDJSON',
+                        help='Where contract results are written: Reports collection (summary) and Reports.results (contracts) or a NDJSON file next to the log file.')
+    parser.add_argument('--resume', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Continue previous execution: contracts, measure types and windows already completed (JOURNAL_PATH) are skipped.')
+    parser.add_argument('--verifyremote', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Check in bulk that contracts without modifications since last execution are on Beedata API with the stored etag. Implies --contractsbulk YES.')
+    parser.add_argument('--enedisasync', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Recover CDC windows of a contract as coroutines of asyncio Enedis client (up to ENEDIS_ASYNC_CONCURRENCY at a time) instead of threads.')
+    parser.add_argument('--profile', type=str, choices=['YES', 'NO'], default='NO',
+                        help='Profile every worker with cProfile and write a merged report with the slowest contracts and functions.')
+    parser.add_argument('--enedisrate', type=float, default=settings.ENEDIS_RATE_LIMIT,
+                        help='Max Enedis requests per second shared by all processes. 0 to disable. Default to ENEDIS_RATE_LIMIT setting.')
     # reading command line arguments
     args = parser.parse_args()
 
     args.forceupdate = True if args.forceupdate == 'YES' else False
+    args.contractsbulk = True if args.contractsbulk == 'YES' else False
+    args.verifyremote = True if args.verifyremote == 'YES' else False
+    args.enediscache = True if args.enediscache == 'YES' else False
+    args.replay = True if args.replay == 'YES' else False
+    args.resume = True if args.resume == 'YES' else False
+    args.profile = True if args.profile == 'YES' else False
+    args.enedisasync = True if args.enedisasync == 'YES' else False
+    if args.replay:
+        # every cached measure is uploaded again whatever state is stored
+        args.forceupdate = True
     
     # start
     run(args)